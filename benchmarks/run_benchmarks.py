@@ -0,0 +1,230 @@
+"""Times and memory-profiles the public create, registry, ingest, state, neighbours and display functions on synthetic
+London-scale data, and compares the results against a stored baseline.
+
+    python benchmarks/run_benchmarks.py --sizes 10000 100000 --resolutions 8 9 10 --save-baseline
+    python benchmarks/run_benchmarks.py --sizes 10000 100000 --resolutions 8 9 10
+
+Peak memory comes from tracemalloc, so it covers Python and NumPy allocations but not GEOS or GDAL internals.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from spatial_helper import create, cube, display, ingest, neighbours, pyramid, registry  # noqa: E402
+from spatial_helper.state import HexStateStore  # noqa: E402
+import synthetic  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def measure(func, repeat=1):
+    """returns the best wall time over repeat runs and the peak traced memory of one more run"""
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"seconds": min(seconds), "peak_mb": peak / 2 ** 20}
+
+
+def grid_cases(boundary, resolution, grid, workdir):
+    """cases that depend only on the grid resolution"""
+
+    wards = synthetic.make_wards()
+    yield "create.h3_from_boundary", lambda: create.h3_from_boundary(boundary, resolution)
+    yield "create.h3_from_boundary[lazy]", lambda: create.h3_from_boundary(boundary, resolution, lazy=True)
+    yield "create.build_h3_grid", lambda: create.build_h3_grid(boundary, resolution, lazy=True,
+                                                               compact_resolution=max(resolution - 3, 0))
+    yield "create.h3_from_coordinates", lambda: create.h3_from_coordinates(resolution, 22000, 180000, 530000)
+    yield "registry.cached_h3_from_boundary[cold]", lambda: (
+        registry.clear_grid_cache(), registry.cached_h3_from_boundary(boundary, resolution))
+    registry.cached_h3_from_boundary(boundary, resolution)
+    yield "registry.cached_h3_from_boundary[warm]", lambda: registry.cached_h3_from_boundary(boundary, resolution)
+    yield "registry.cached_h3_from_coordinates[cold]", lambda: (
+        registry.clear_grid_cache(), registry.cached_h3_from_coordinates(resolution, 22000, 180000, 530000))
+    registry.cached_h3_from_coordinates(resolution, 22000, 180000, 530000)
+    yield "registry.cached_h3_from_coordinates[warm]", lambda: registry.cached_h3_from_coordinates(
+        resolution, 22000, 180000, 530000)
+    yield "ingest.overlap_weights", lambda: ingest.overlap_weights(wards, "ward", grid, "h3_ref")
+    yield "ingest.overlap_to_grid", lambda: ingest.overlap_to_grid(wards, "ward", grid.copy(), "h3_ref")
+    yield "ingest.bcu_to_grid", lambda: ingest.bcu_to_grid(wards.rename(columns={"ward": "BCU_Code"}),
+                                                           grid.rename(columns={"h3_ref": "CAD_Ref"}))
+    yield "ingest.largest_overlap_to_grid", lambda: ingest.largest_overlap_to_grid(wards, "ward", grid.copy(),
+                                                                                   "h3_ref")
+
+
+def point_cases(grid, lazy_grid, size, workdir, max_sjoin, max_files):
+    """cases that depend on the number of points as well as the grid"""
+
+    cads = synthetic.make_cads(size)
+    crimes = synthetic.make_crimes(size)
+    lookup = synthetic.make_cchi_lookup()
+    features = cads.assign(UNIQUE_REFERENCE_NUMBER=range(size), osm_id=range(size),
+                           type=cads["OpeningCode_Description"])
+    overlap = ingest.overlap_weights(synthetic.make_wards(), "ward", grid, "h3_ref")
+    counts = ingest.cad_to_grid(lazy_grid, "h3_ref", cads, method="h3")
+    if size <= max_sjoin:
+        yield "ingest.cad_to_grid[sjoin]", lambda: ingest.cad_to_grid(grid.copy(), "h3_ref", cads)
+        yield "ingest.calc_cchi_batch[sjoin]", lambda: ingest.calc_cchi_batch(grid, crimes, lookup)
+    yield "ingest.cad_to_grid[h3]", lambda: ingest.cad_to_grid(lazy_grid, "h3_ref", cads, method="h3")
+    yield "ingest.cad_to_grid_time[h3]", lambda: ingest.cad_to_grid_time(lazy_grid, "h3_ref", cads.copy(), "night",
+                                                                         method="h3")
+    yield "ingest.os_poi_to_hex[h3]", lambda: ingest.os_poi_to_hex(features, lazy_grid, method="h3")
+    yield "ingest.osm_feat_to_hex[h3]", lambda: ingest.osm_feat_to_hex(features, lazy_grid, "ASB Nuisance",
+                                                                       method="h3")
+    yield "ingest.apportion_counts", lambda: ingest.apportion_counts(counts, "h3_ref", overlap, "ward", ["count"])
+    yield "ingest.cad_to_grid_cats[h3]", lambda: ingest.cad_to_grid_cats(lazy_grid, "h3_ref", cads, method="h3",
+                                                                         codes=None)
+    yield "ingest.crime_cad_grid[h3]", lambda: ingest.crime_cad_grid(crimes, lazy_grid, "h3_ref", "all", "h3")
+    yield "ingest.calc_cchi[h3]", lambda: ingest.calc_cchi(lazy_grid, crimes[crimes["minor_class"] == "minor_0"],
+                                                           lookup, "minor_0", method="h3")
+    yield "ingest.calc_cchi_batch[h3]", lambda: ingest.calc_cchi_batch(lazy_grid, crimes, lookup, method="h3",
+                                                                       matrix=True)
+    yield "pyramid.build_pyramid", lambda: pyramid.build_pyramid(cads, lazy_grid.resolution,
+                                                                 max(lazy_grid.resolution - 3, 0))
+    coarsest = max(lazy_grid.resolution - 3, 0)
+    levels = pyramid.build_pyramid(cads, lazy_grid.resolution, coarsest)
+    yield "pyramid.pyramid_level", lambda: [pyramid.pyramid_level(levels, resolution)
+                                            for resolution in range(coarsest, lazy_grid.resolution + 1)]
+    for storage, path in (("dense", "cube.npy"), ("sparse", "cube.npz")):
+        path = os.path.join(workdir, path)
+        yield "cube.build_cube[" + storage + "]", lambda path=path, storage=storage: cube.build_cube(
+            cads, lazy_grid, path, by_week=True, sparse=storage == "sparse")
+        yield "cube.SpaceTimeCube.window[" + storage + "]", lambda path=path: cube.SpaceTimeCube.load(path).window(
+            hours=ingest.TIME_HOURS["night"], weekdays=[5, 6])
+    if size <= max_files:
+        cad_dir = os.path.join(workdir, "cad_%d" % size)
+        cris_dir = os.path.join(workdir, "cris_%d" % size)
+        synthetic.write_cad_directory(cad_dir, size)
+        synthetic.write_cris_directory(cris_dir, size)
+        yield "ingest.agg_cad_directory[h3]", lambda: ingest.agg_cad_directory(cad_dir, lazy_grid, "h3_ref",
+                                                                               method="h3")
+        yield "ingest.agg_cad_directory[streaming]", lambda: ingest.agg_cad_directory(
+            cad_dir, lazy_grid, "h3_ref", method="h3", streaming=True, chunksize=100000)
+        yield "ingest.agg_cad_directory_time[streaming]", lambda: ingest.agg_cad_directory_time(
+            cad_dir, lazy_grid, "h3_ref", method="h3", time="night", streaming=True, chunksize=100000)
+        yield "ingest.agg_cad_code_directory[streaming]", lambda: ingest.agg_cad_code_directory(
+            cad_dir, "ASB Nuisance", "asb", lazy_grid, "h3_ref", method="h3", streaming=True, chunksize=100000)
+        yield "ingest.agg_cris_directory[h3]", lambda: ingest.agg_cris_directory(cris_dir, lazy_grid, "h3_ref",
+                                                                                 method="h3")
+        yield "state.HexStateStore.sync_directory", lambda: HexStateStore(
+            tempfile.mkdtemp(dir=workdir), lazy_grid).sync_directory(cad_dir)
+        store = HexStateStore(tempfile.mkdtemp(dir=workdir), lazy_grid)
+        store.sync_directory(cad_dir)
+        yield "state.HexStateStore.table", lambda: store.table()
+
+
+def score_cases(lazy_grid, workdir):
+    """cases on a per-hex score table"""
+
+    scores = lazy_grid.to_frame()
+    scores["score"] = range(len(scores))
+    scores["t_centre_name"] = synthetic.make_bcu_geodata(scores["h3_ref"])["t_centre_name"].to_numpy()
+    wards = synthetic.make_wards().to_crs(lazy_grid.crs)
+    geodata = synthetic.make_bcu_geodata(scores["h3_ref"])
+    weights = neighbours.grid_weights(lazy_grid)
+    yield "neighbours.grid_weights", lambda: (
+        neighbours._weights.clear(), neighbours.grid_weights(lazy_grid, k=2, kernel=lambda ring: 1 / (1 + ring)))
+    yield "neighbours.smooth", lambda: neighbours.smooth(scores, ["score"], weights)
+    yield "neighbours.getis_ord_gi_star", lambda: neighbours.getis_ord_gi_star(scores, ["score"], weights)
+    yield "display.generate_map", lambda: display.generate_map(scores, "score", "h3_ref", top_count=None,
+                                                               compact=True, precision=5).get_root().render()
+    yield "display.generate_cust_map", lambda: display.generate_cust_map(
+        scores, "score", "h3_ref", top_count=None, values_to_show=["t_centre_name"], compact=True,
+        precision=5).get_root().render()
+    yield "display.generate_h3_map", lambda: display.generate_h3_map(scores, "score").get_root().render()
+    yield "display.make_bcu_map", lambda: display.make_bcu_map(wards, lazy_grid, geodata, "BCU0",
+                                                               output_dir=os.path.join(workdir, "bcu_map"))
+    yield "display.make_bcu_maps", lambda: display.make_bcu_maps(wards, lazy_grid, geodata,
+                                                                 os.path.join(workdir, "bcu_maps"), workers=1)
+
+
+def run(sizes, resolutions, repeat=1, only=None, max_sjoin=1000000, max_files=1000000):
+    """runs every case and returns a dict of case key to timings"""
+
+    results = {}
+    boundary = synthetic.london_boundary()
+    with tempfile.TemporaryDirectory() as workdir:
+        for resolution in resolutions:
+            grid = create.h3_from_boundary(boundary, resolution).to_crs("EPSG:27700")
+            lazy_grid = create.h3_from_boundary(boundary, resolution, lazy=True)
+            suffix = "|res=" + str(resolution)
+            _run_cases(grid_cases(boundary, resolution, grid, workdir), suffix, repeat, only, results)
+            _run_cases(score_cases(lazy_grid, workdir), suffix, repeat, only, results)
+            for size in sizes:
+                _run_cases(point_cases(grid, lazy_grid, size, workdir, max_sjoin, max_files),
+                           suffix + "|n=" + str(size), repeat, only, results)
+    return results
+
+
+def _run_cases(cases, suffix, repeat, only, results):
+    """measures each case as it is generated, so a case only ever sees the data set up for it"""
+
+    for name, func in cases:
+        key = name + suffix
+        if only and only not in key:
+            continue
+        results[key] = measure(func, repeat)
+        print("{:<60} {:>9.3f}s {:>9.1f}MB".format(key, results[key]["seconds"], results[key]["peak_mb"]),
+              flush=True)
+
+
+def compare(results, baseline, tolerance):
+    """prints each case against its baseline and returns the keys that got slower or bigger beyond tolerance"""
+
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        time_ratio = result["seconds"] / max(baseline[key]["seconds"], 1e-9)
+        memory_ratio = result["peak_mb"] / max(baseline[key]["peak_mb"], 1e-9)
+        flag = ""
+        if time_ratio > 1 + tolerance or memory_ratio > 1 + tolerance:
+            regressions.append(key)
+            flag = "REGRESSION"
+        print("{:<60} time x{:>6.2f} memory x{:>6.2f} {}".format(key, time_ratio, memory_ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[8, 9])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--only", help="only run cases whose key contains this text")
+    parser.add_argument("--max-sjoin-points", type=int, default=1000000)
+    parser.add_argument("--max-file-points", type=int, default=1000000)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    warnings.filterwarnings("ignore")
+    results = run(args.sizes, args.resolutions, args.repeat, args.only, args.max_sjoin_points,
+                  args.max_file_points)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as stored:
+            baseline = json.load(stored)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as stored:
+            json.dump(baseline, stored, indent=1, sort_keys=True)
+        return 0
+    return 1 if compare(results, baseline, args.tolerance) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""Seeded synthetic CAD and CRIS data shaped like the MPS MapInfo exports, for benchmarking without real data."""
+import os
+import numpy as np
+import pandas as pd
+import geopandas
+import shapely
+
+LONDON_CENTRE = (530000, 180000)
+OPENING_CODES = ["ASB Nuisance", "Police Generated Res", "Violence Against The", "Concern For Safety",
+                 "Suspicious Circumstances", "Domestic Incident", "Road Related Offence", "Burglary",
+                 "Theft", "Disturbance"]
+MAJOR_CLASSES = ["Burglary", "Robbery", "Theft", "Violence Against The Person", "Sexual Offences"]
+
+
+def london_boundary(radius=22000):
+    """returns a rough Greater London sized boundary in OSGB, centred on Charing Cross"""
+
+    circle = shapely.Point(*LONDON_CENTRE).buffer(radius, quad_segs=32)
+    return geopandas.GeoDataFrame({"name": ["London"]}, geometry=[circle], crs="EPSG:27700")
+
+
+def _points(n, rng, radius=22000, hotspots=40):
+    """returns OSGB X/Y for n points, half spread over the boundary and half clustered around random hotspots"""
+
+    spread = n // 2
+    angle = rng.uniform(0, 2 * np.pi, spread)
+    distance = radius * np.sqrt(rng.uniform(0, 1, spread))
+    centres = rng.uniform(-radius * 0.7, radius * 0.7, (hotspots, 2))
+    cluster = centres[rng.integers(0, hotspots, n - spread)] + rng.normal(0, 400, (n - spread, 2))
+    x = np.concatenate([distance * np.cos(angle), cluster[:, 0]]) + LONDON_CENTRE[0]
+    y = np.concatenate([distance * np.sin(angle), cluster[:, 1]]) + LONDON_CENTRE[1]
+    return x.round(), y.round()
+
+
+def make_cads(n, seed=0):
+    """returns n synthetic CAD records with the export's column names"""
+
+    rng = np.random.default_rng(seed)
+    x, y = _points(n, rng)
+    profile = 1.3 + np.sin((np.arange(24) - 9) / 24 * 2 * np.pi)
+    hours = rng.choice(24, n, p=profile / profile.sum())
+    dates = pd.Timestamp("2021-01-01") + pd.to_timedelta(rng.integers(0, 365, n), unit="D")
+    frame = pd.DataFrame({
+        "IncidentNumber": ["CAD" + str(seed) + "-" + str(number) for number in range(n)],
+        "IncidentDate": dates.strftime("%Y-%m-%d"),
+        "IncidentTime": ["{:02d}:{:02d}".format(hour, minute) for hour, minute in zip(hours, rng.integers(0, 60, n))],
+        "OpeningCode_Description": rng.choice(OPENING_CODES, n),
+        "X": x,
+        "Y": y})
+    return geopandas.GeoDataFrame(frame, geometry=geopandas.points_from_xy(x, y), crs="EPSG:27700")
+
+
+def make_crimes(n, seed=0, minor_classes=100):
+    """returns n synthetic CRIS records with the export's column names and a minor_class column"""
+
+    rng = np.random.default_rng(seed + 1)
+    x, y = _points(n, rng)
+    dates = pd.Timestamp("2021-01-01") + pd.to_timedelta(rng.integers(0, 365 * 24 * 60, n), unit="min")
+    frame = pd.DataFrame({
+        "CRNumber": ["CR" + str(seed) + "-" + str(number) for number in range(n)],
+        "SUPV_CR_Recorded_Date": dates.strftime("%Y%m%d%H%M"),
+        "major_class": rng.choice(MAJOR_CLASSES, n),
+        "minor_class": ["minor_" + str(number) for number in rng.integers(0, minor_classes, n)],
+        "X": x,
+        "Y": y})
+    return geopandas.GeoDataFrame(frame, geometry=geopandas.points_from_xy(x, y), crs="EPSG:27700")
+
+
+def make_cchi_lookup(minor_classes=100, seed=0):
+    """returns a CCHI lookup with a harm weight for every synthetic minor class"""
+
+    rng = np.random.default_rng(seed + 2)
+    return pd.DataFrame({"cris_minor": ["minor_" + str(number) for number in range(minor_classes)],
+                         "CrimeHarm": rng.gamma(2, 50, minor_classes).round(1)})
+
+
+def write_cad_directory(directory, n, files=4, seed=0):
+    """writes n synthetic CAD records split across borough style .tab files"""
+
+    os.makedirs(directory, exist_ok=True)
+    for number, part in enumerate(np.array_split(np.arange(n), files)):
+        cads = make_cads(len(part), seed + number)
+        cads.to_file(os.path.join(directory, "Borough" + str(number) + "_cad.tab"), driver="MapInfo File")
+
+
+def write_cris_directory(directory, n, files_per_class=2, seed=0):
+    """writes n synthetic CRIS records as .tab files named by major class, as agg_cris_directory expects"""
+
+    os.makedirs(directory, exist_ok=True)
+    crimes = make_crimes(n, seed)
+    for major_class, group in crimes.groupby("major_class"):
+        for number, part in enumerate(np.array_split(np.arange(len(group)), files_per_class)):
+            group.iloc[part].drop(columns=["major_class", "minor_class"]).to_file(
+                os.path.join(directory, major_class + "_" + str(number) + ".tab"), driver="MapInfo File")
+
+
+def make_wards(side=12, radius=22000):
+    """returns a square tiling of the boundary as ward style polygons in OSGB, each with a ward code"""
+
+    edges = np.linspace(-radius, radius, side + 1)
+    boxes = [shapely.box(LONDON_CENTRE[0] + x0, LONDON_CENTRE[1] + y0, LONDON_CENTRE[0] + x1, LONDON_CENTRE[1] + y1)
+             for x0, x1 in zip(edges[:-1], edges[1:]) for y0, y1 in zip(edges[:-1], edges[1:])]
+    return geopandas.GeoDataFrame({"ward": ["W" + str(number) for number in range(len(boxes))]}, geometry=boxes,
+                                  crs="EPSG:27700")
+
+
+def make_bcu_geodata(refs, seed=0, bcus=4):
+    """returns a ranked geodata output, as make_bcu_maps expects, for a list of h3 refs"""
+
+    rng = np.random.default_rng(seed + 3)
+    frame = pd.DataFrame({"h3_ref": list(refs),
+                          "BCU_Name": ["BCU" + str(number) for number in rng.integers(0, bcus, len(refs))],
+                          "t_centre_name": rng.choice(["Croydon", "Ealing", "Romford", "Stratford", "Wood Green"],
+                                                      len(refs)),
+                          "Final_score": rng.gamma(2, 10, len(refs)).round(2),
+                          "Previous entries": rng.integers(0, 3, len(refs))})
+    return frame.sort_values(by="Final_score", ascending=False, ignore_index=True)
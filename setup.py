@@ -13,4 +13,9 @@ setup(
         "geopandas",
         "folium",
         "h3"],
+    extras_require={
+        "cache": ["pyarrow"],
+        "sparse": ["scipy"]},
+    entry_points={
+        "console_scripts": ["spatial-helper=spatial_helper.cli:main"]},
 )
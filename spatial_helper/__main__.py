@@ -0,0 +1,4 @@
+import sys
+from spatial_helper.cli import main
+
+sys.exit(main())
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import geopandas
+from spatial_helper.instrument import stage
+
+DEFAULT_CACHE_BYTES = 2 * 1024 ** 3
+MAPINFO_PARTS = [".dat", ".map", ".id", ".ind"]
+
+
+def cache_key(path):
+    """returns a key for a file based on its full path, size and modification time, so that any change to the file
+    gives a new key. A MapInfo .tab only holds the table header, so the size and modification time of its sibling
+    .dat, .map, .id and .ind files go into the key as well """
+
+    stat = os.stat(path)
+    key = "{}|{}|{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if path.lower().endswith(".tab"):
+        stem = path[:-4]
+        for extension in MAPINFO_PARTS:
+            for part in (stem + extension, stem + extension.upper()):
+                if os.path.exists(part):
+                    part_stat = os.stat(part)
+                    key += "|{}|{}|{}".format(extension, part_stat.st_size, part_stat.st_mtime_ns)
+                    break
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def evict(cache_dir, max_bytes=DEFAULT_CACHE_BYTES, suffix=".parquet", keep=()):
+    """deletes the least recently used files in a cache directory until it is under max_bytes, never deleting the
+    paths in keep. Files removed by another process in the meantime are skipped, so processes can share a cache """
+
+    keep = {os.path.abspath(path) for path in keep}
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(suffix):
+            path = os.path.join(cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(entry[1] for entry in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _parquet_columns(path):
+    import pyarrow.parquet
+
+    return pyarrow.parquet.read_schema(path).names
+
+
+def read_tab(path, columns=None, cache_dir=None, max_bytes=DEFAULT_CACHE_BYTES):
+    """reads a MapInfo .tab export. Given a cache directory, the file is converted to GeoParquet the first time it is
+    read and later reads load only the requested columns from that copy. The cache is capped at max_bytes, evicting
+    the least recently used files first, and can be shared by several processes. Needs pyarrow when a cache
+    directory is used """
+
+    if cache_dir is None:
+        return _select(_read_source(path), columns, False)
+    os.makedirs(cache_dir, exist_ok=True)
+    cached = os.path.join(cache_dir, cache_key(path) + ".parquet")
+    try:
+        os.utime(cached)
+        if columns is not None:
+            available = _parquet_columns(cached)
+            columns = [column for column in columns if column in available]
+            if "geometry" not in columns:
+                columns.append("geometry")
+        with stage("read_cached_tab") as record:
+            frame = geopandas.read_parquet(cached, columns=columns)
+            record["rows"] = len(frame)
+        return frame
+    except FileNotFoundError:
+        pass
+    frame = _read_source(path)
+    temp = cached + "." + str(os.getpid()) + ".tmp"
+    frame.to_parquet(temp, index=False)
+    os.replace(temp, cached)
+    evict(cache_dir, max_bytes, keep=[cached])
+    return _select(frame, columns, True)
+
+
+def _read_source(path):
+    with stage("read_tab") as record:
+        frame = geopandas.read_file(path, crs="EPSG:27700")
+        record["rows"] = len(frame)
+    return frame
+
+
+def _select(frame, columns, with_geometry):
+    """keeps the requested columns that exist, as the cached and uncached reads each return them"""
+
+    if columns is None:
+        return frame
+    columns = [column for column in columns if column in frame.columns]
+    if with_geometry and "geometry" not in columns:
+        columns.append("geometry")
+    return frame[columns]
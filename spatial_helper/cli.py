@@ -0,0 +1,239 @@
+import argparse
+import json
+import logging
+import os
+import sys
+from spatial_helper.instrument import logger, stage
+
+STAGES = ["grid", "ingest", "score", "export", "map"]
+
+
+def load_config(path):
+    """reads a pipeline config from a JSON file, resolving every path in it against the config's own directory so
+    scheduled jobs do not depend on the directory they are started from """
+
+    with open(path) as config_file:
+        config = json.load(config_file)
+    base = os.path.dirname(os.path.abspath(path))
+    return _resolve_paths(config, base)
+
+
+def _resolve_paths(value, base, key=None):
+    """expands ~ and makes relative paths absolute for every path-like key of a config"""
+
+    if isinstance(value, dict):
+        return {name: _resolve_paths(item, base, name) for name, item in value.items()}
+    if isinstance(value, list):
+        return [_resolve_paths(item, base, key) for item in value]
+    if isinstance(value, str) and key is not None and (key in ("boundary", "directory", "path")
+                                                       or key.endswith("_dir")):
+        return os.path.normpath(os.path.join(base, os.path.expanduser(value)))
+    return value
+
+
+def build_grid(config, results):
+    """builds the grid from a boundary file or a square of coordinates. With the h3 method and no grid cache the grid
+    is kept as ids only, so no polygons are made unless a later stage needs them """
+
+    options = config["grid"]
+    method = config.get("method", "h3")
+    lazy = options.get("lazy", method == "h3" and "cache_dir" not in options)
+    if "boundary" in options:
+        import geopandas
+
+        boundary = geopandas.read_file(options["boundary"])
+        if "cache_dir" in options:
+            from spatial_helper.registry import cached_h3_from_boundary
+
+            grid = cached_h3_from_boundary(boundary, options["resolution"], options.get("buffer", 0),
+                                           options["cache_dir"])
+        else:
+            from spatial_helper.create import build_h3_grid
+
+            grid = build_h3_grid(boundary, options["resolution"], options.get("buffer", 0),
+                                 tiles=options.get("tiles", 4), workers=options.get("workers"), lazy=lazy)
+    else:
+        coordinates = options["coordinates"]
+        if "cache_dir" in options:
+            from spatial_helper.registry import cached_h3_from_coordinates
+
+            grid = cached_h3_from_coordinates(options["resolution"], coordinates["size"], coordinates.get("x", 0),
+                                              coordinates.get("y", 0), coordinates.get("crs_type", "osgb"),
+                                              options["cache_dir"])
+        else:
+            from spatial_helper.create import h3_from_coordinates
+
+            grid = h3_from_coordinates(options["resolution"], coordinates["size"], coordinates.get("x", 0),
+                                       coordinates.get("y", 0), coordinates.get("crs_type", "osgb"), lazy=lazy)
+    results["grid"] = grid
+    from spatial_helper.create import HexGrid
+
+    results["table"] = grid.to_frame() if isinstance(grid, HexGrid) else grid.copy()
+    return len(grid)
+
+
+def ingest_directories(config, results):
+    """aggregates every configured CAD or CRIS directory against the grid and joins the counts onto the running
+    table, keyed by the grid ref """
+
+    from spatial_helper import ingest
+
+    grid, table = results["grid"], results["table"]
+    grid_ref = config.get("grid_ref", "h3_ref")
+    method = config.get("method", "h3")
+    cache_dir = config.get("cache_dir")
+    for source in config["ingest"]:
+        kind = source.get("kind", "cad")
+        logger.info("Ingesting %s directory %s", kind, source["directory"])
+        if kind == "cad":
+            counts = ingest.agg_cad_directory(source["directory"], grid, grid_ref, source.get("exclude_shout", True),
+                                              method, source.get("streaming", True), source.get("chunksize"),
+                                              cache_dir)
+        elif kind == "cad_time":
+            counts = ingest.agg_cad_directory_time(source["directory"], grid, grid_ref,
+                                                   source.get("exclude_shout", True), method,
+                                                   source.get("time", "day"), source.get("streaming", True),
+                                                   source.get("chunksize"), cache_dir)
+        elif kind == "cad_code":
+            counts = ingest.agg_cad_code_directory(source["directory"], source["theme"], source["suffix"], grid,
+                                                   grid_ref, method, source.get("streaming", True),
+                                                   source.get("chunksize"), cache_dir)
+        elif kind == "cris":
+            counts = ingest.agg_cris_directory(source["directory"], grid, grid_ref, method, source.get("workers"),
+                                               cache_dir)
+            counts = counts.assign(**{grid_ref: table[grid_ref].to_numpy()})
+        else:
+            raise ValueError("Unknown ingest kind " + str(kind))
+        columns = [column for column in counts.columns if column not in (grid_ref, "geometry")]
+        if "suffix" in source and kind != "cad_code":
+            counts = counts.rename(columns={column: column + "_" + source["suffix"] for column in columns})
+            columns = [column + "_" + source["suffix"] for column in columns]
+        table = table.merge(counts[[grid_ref] + columns], how="left", on=grid_ref)
+    results["table"] = table
+    return len(table)
+
+
+def score_grid(config, results):
+    """adds a weighted sum of count columns as a score, and optionally its neighbourhood smoothed value and its
+    Getis-Ord Gi* z-score over k rings """
+
+    options = config["score"]
+    grid_ref = config.get("grid_ref", "h3_ref")
+    column = options.get("column", "score")
+    table = results["table"]
+    score = 0
+    for name, weight in options["weights"].items():
+        score = score + table[name].fillna(0) * float(weight)
+    table[column] = score
+    if options.get("smooth") or options.get("hotspots"):
+        from spatial_helper import neighbours
+
+        grid = results["grid"]
+        if options.get("smooth"):
+            weights = neighbours.grid_weights(grid, options["smooth"], grid_ref=grid_ref,
+                                              cache_dir=config.get("cache_dir"))
+            table[column + "_smooth"] = neighbours.smooth(table, [column], weights, grid_ref)[column + "_smooth"]
+        if options.get("hotspots"):
+            weights = neighbours.grid_weights(grid, options["hotspots"], grid_ref=grid_ref,
+                                              cache_dir=config.get("cache_dir"))
+            table[column + "_gi"] = neighbours.getis_ord_gi_star(table, [column], weights, grid_ref)[column + "_gi"]
+    results["table"] = table
+    return len(table)
+
+
+def export_table(config, results):
+    """writes the table as parquet, csv or GeoJSON, chosen by the file extension. Tables without polygons are
+    written without geometry """
+
+    path = config["export"]["path"]
+    table = results["table"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if path.endswith(".parquet"):
+        table.to_parquet(path, index=False)
+    elif path.endswith(".csv"):
+        table.drop(columns="geometry", errors="ignore").to_csv(path, index=False)
+    elif path.endswith(".geojson"):
+        if "geometry" not in table.columns:
+            from spatial_helper.create import add_h3_geometry
+
+            table = add_h3_geometry(table, config.get("grid_ref", "h3_ref"))
+        table.to_crs("EPSG:4326").to_file(path, driver="GeoJSON")
+    else:
+        raise ValueError("Unsupported export format " + path)
+    logger.info("Wrote %s", path)
+    return len(table)
+
+
+def render_map(config, results):
+    """writes an interactive map of a score column, drawing the hexagons client side from their refs"""
+
+    from spatial_helper.display import generate_h3_map
+
+    options = config["map"]
+    path = options["path"]
+    table = results["table"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    map_osm = generate_h3_map(table.drop(columns="geometry", errors="ignore"),
+                              options.get("category", config.get("score", {}).get("column", "score")),
+                              config.get("grid_ref", "h3_ref"), options.get("top_count"),
+                              options.get("values_to_show", []))
+    map_osm.save(path)
+    logger.info("Wrote %s", path)
+    return len(table)
+
+
+STAGE_FUNCTIONS = {"grid": build_grid, "ingest": ingest_directories, "score": score_grid, "export": export_table,
+                   "map": render_map}
+
+
+def run_pipeline(config, stages=None):
+    """runs every stage named in the config, in pipeline order, passing the grid and the running table from one
+    stage to the next in memory. Returns those results """
+
+    stages = [name for name in STAGES if name in config] if stages is None else stages
+    if "grid" not in stages:
+        raise ValueError("A pipeline needs a grid stage")
+    results = {}
+    for name in stages:
+        with stage("pipeline." + name) as record:
+            record["rows"] = STAGE_FUNCTIONS[name](config, results)
+    return results
+
+
+def main(argv=None):
+    """console entry point: runs the pipeline a JSON config describes, headless"""
+
+    parser = argparse.ArgumentParser(prog="spatial-helper", description="Run a spatial_helper pipeline: build a "
+                                     "grid, ingest directories, score, then export and map.")
+    parser.add_argument("config", help="path to a JSON pipeline config")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, help="run only these stages (grid is always needed)")
+    parser.add_argument("--metrics", help="append per-stage timings and peak RSS as JSON lines to this file")
+    parser.add_argument("--memory", action="store_true", help="also trace each stage's peak memory with tracemalloc, "
+                        "which slows the stages down")
+    parser.add_argument("--profile", help="write cProfile stats for the run to this file")
+    parser.add_argument("--quiet", action="store_true", help="only log warnings and errors")
+    args = parser.parse_args(argv)
+
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(logging.WARNING if args.quiet else logging.INFO)
+    config = load_config(args.config)
+    instrumented = args.metrics or args.profile or args.memory
+    if instrumented:
+        from spatial_helper import instrument
+
+        instrument.enable(metrics_path=args.metrics, memory=args.memory, profile_path=args.profile,
+                          level=logger.level)
+    try:
+        stages = None if args.stages is None else [name for name in STAGES if name in args.stages]
+        run_pipeline(config, stages)
+    finally:
+        if instrumented:
+            instrument.disable()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
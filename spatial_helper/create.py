@@ -1,38 +1,183 @@
+from concurrent.futures import ProcessPoolExecutor
 import geopandas
+import numpy as np
+import shapely
 from h3 import h3
-from shapely.geometry import Polygon
+from h3.api import basic_int as h3_int
 import pandas as pd
+from spatial_helper.instrument import stage
 
 
-def h3_from_boundary(boundary, resolution, buffer=0):
-    """given a spatial polygon, returns a h3 hex grid at the given resolution for the same area with an
-    optional buffer in degrees """
+class HexGrid:
+    """a h3 grid held only as a uint64 array of cell ids, with polygons built in vectorised batches when geometry is
+    actually needed. The crs is the one geometry is returned in """
+
+    def __init__(self, cells, crs="EPSG:4326"):
+        self.cells = np.asarray(cells, dtype="uint64")
+        self.crs = crs
+
+    @classmethod
+    def from_refs(cls, refs, crs="EPSG:4326"):
+        """builds a grid from h3 reference strings, such as an h3_ref column"""
+
+        return cls(np.array([int(ref, 16) for ref in refs], dtype="uint64"), crs)
+
+    def __len__(self):
+        return len(self.cells)
+
+    @property
+    def resolution(self):
+        return h3_int.h3_get_resolution(int(self.cells[0]))
+
+    @property
+    def h3_ref(self):
+        return pd.Index([format(cell, "x") for cell in self.cells.tolist()], dtype=object, name="h3_ref")
+
+    def to_frame(self):
+        """returns a plain frame of h3_ref strings for merging against h3_ref keyed tables"""
+
+        return pd.DataFrame({"h3_ref": self.h3_ref})
+
+    def to_geodataframe(self, batch_size=100000):
+        """materialises the polygons and returns the grid in the same shape as h3_from_boundary"""
+
+        return add_h3_geometry(self.to_frame(), "h3_ref", self.crs, batch_size)
+
+
+def h3_polygons(cells):
+    """builds the polygons for an array of h3 cells, grouping cells by vertex count so that each group is built in
+    one vectorised call """
 
-    boundary["city"] = "all"
-    buffered = boundary.copy()
-    buffered = buffered.to_crs("EPSG:4326")
+    with stage("h3_polygons", len(cells)):
+        boundaries = [h3_int.h3_to_geo_boundary(int(cell), geo_json=True) for cell in cells]
+        polygons = np.empty(len(boundaries), dtype=object)
+        sizes = np.array([len(boundary) for boundary in boundaries])
+        for size in np.unique(sizes):
+            rows = np.flatnonzero(sizes == size)
+            polygons[rows] = shapely.polygons(np.array([boundaries[row] for row in rows]))
+    return polygons
+
+
+def add_h3_geometry(frame, key="h3_ref", crs="EPSG:4326", batch_size=100000):
+    """takes a frame with a column of h3 references and returns it as a geodataframe with the hex polygons, built in
+    batches and projected to crs """
+
+    cells = np.array([int(ref, 16) for ref in frame[key]], dtype="uint64")
+    polygons = [h3_polygons(cells[start:start + batch_size]) for start in range(0, len(cells), batch_size)]
+    geometry = np.concatenate(polygons) if polygons else np.array([], dtype=object)
+    geo_frame = geopandas.GeoDataFrame(frame.copy(), geometry=geopandas.GeoSeries(geometry, index=frame.index,
+                                                                                  crs="EPSG:4326"))
+    if crs is not None and crs != "EPSG:4326":
+        with stage("reproject", len(geo_frame)):
+            geo_frame = geo_frame.to_crs(crs)
+    return geo_frame
+
+
+def _boundary_geometry(boundary, buffer=0):
+    """dissolves a boundary into a single lat-long geometry, with an optional buffer in degrees"""
+
+    buffered = boundary.assign(city="all").to_crs("EPSG:4326")
     lon_buffer = buffered.dissolve(by="city")
     lon_buffer["geometry"] = lon_buffer["geometry"].buffer(buffer)
+    return lon_buffer.iloc[0]["geometry"]
+
 
-    hexs = h3.polyfill(buffered.iloc[0]["geometry"].__geo_interface__, resolution, geo_json_conformant=True)
+def _polygon_parts(geometry):
+    """splits any geometry into the list of polygons h3.polyfill can take"""
 
-    polygonise = lambda hex_id: Polygon(
-        h3.h3_to_geo_boundary(
-            hex_id, geo_json=True)
-    )
+    if geometry.is_empty:
+        return []
+    if geometry.geom_type == "Polygon":
+        return [geometry]
+    return [part for sub_geometry in getattr(geometry, "geoms", []) for part in _polygon_parts(sub_geometry)]
 
-    all_polys = geopandas.GeoSeries(list(map(polygonise, hexs)),
-                                    index=hexs
-                                    )
-    london_hex = geopandas.GeoDataFrame(data=all_polys, columns=["geometry"]).reset_index().rename(
-        columns={"index": "h3_ref"})
-    return london_hex
 
+def _polyfill(geometry, resolution):
+    """returns the set of h3 cells, as integers, with centres inside a geometry"""
 
-def h3_from_coordinates(resolution, size, x=0, y=0, crs_type="osgb"):
+    cells = set()
+    for part in _polygon_parts(geometry):
+        cells.update(h3_int.polyfill(part.__geo_interface__, resolution, geo_json_conformant=True))
+    return cells
+
+
+def h3_from_boundary(boundary, resolution, buffer=0, lazy=False):
+    """given a spatial polygon, returns a h3 hex grid at the given resolution for the same area with an
+    optional buffer in degrees. Set lazy to get an id-only HexGrid instead of polygons """
+
+    with stage("polyfill") as record:
+        hexs = np.array(sorted(_polyfill(_boundary_geometry(boundary, buffer), resolution)), dtype="uint64")
+        record["rows"] = len(hexs)
+    grid = HexGrid(hexs)
+    if lazy:
+        return grid
+    return grid.to_geodataframe()
+
+
+def _tile_parts(geometry, tiles):
+    """cuts a geometry into a tiles x tiles grid over its bounds and returns the non-empty polygon pieces"""
+
+    min_x, min_y, max_x, max_y = geometry.bounds
+    xs = np.linspace(min_x, max_x, tiles + 1)
+    ys = np.linspace(min_y, max_y, tiles + 1)
+    parts = []
+    for i in range(tiles):
+        for j in range(tiles):
+            tile = shapely.box(xs[i], ys[j], xs[i + 1], ys[j + 1])
+            parts.extend(_polygon_parts(geometry.intersection(tile)))
+    return parts
+
+
+def _compact_interior(geometry, resolution, compact_resolution):
+    """fills the interior of a geometry with coarse cells and uncompacts them to the target resolution. Returns the
+    interior cells and the remaining edge area, which still needs a fine polyfill. Coarse cells are kept a margin of
+    one child cell inside the boundary so their uncompacted children cannot stray outside it """
+
+    latitude = geometry.centroid.y
+    margin = h3.edge_length(compact_resolution + 1, unit="km") / (111.32 * np.cos(np.radians(latitude)))
+    inner = geometry.buffer(-margin)
+    coarse = np.array(sorted(_polyfill(inner, compact_resolution)), dtype="uint64")
+    if len(coarse) == 0:
+        return set(), geometry
+    polygons = h3_polygons(coarse)
+    coarse = coarse[shapely.within(polygons, inner)]
+    if len(coarse) == 0:
+        return set(), geometry
+    interior = set(h3_int.uncompact([int(cell) for cell in coarse], resolution))
+    covered = shapely.union_all(h3_polygons(coarse)).buffer(-margin)
+    return interior, geometry.difference(covered)
+
+
+def build_h3_grid(boundary, resolution, buffer=0, tiles=4, workers=None, compact_resolution=None, lazy=False):
+    """builds the same grid as h3_from_boundary for large boundaries. The boundary is cut into tiles x tiles pieces
+    which are polyfilled in a pool of worker processes (None uses every core, 1 runs in this process) and
+    deduplicated. Given a coarser compact_resolution, the interior is filled at that resolution and uncompacted, so
+    only the edges are polyfilled at full resolution """
+
+    geometry = _boundary_geometry(boundary, buffer)
+    cells = set()
+    if compact_resolution is not None and compact_resolution < resolution:
+        cells, geometry = _compact_interior(geometry, resolution, compact_resolution)
+    parts = _tile_parts(geometry, tiles)
+    with stage("tiled_polyfill") as record:
+        if workers == 1 or len(parts) < 2:
+            filled = [_polyfill(part, resolution) for part in parts]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                filled = list(pool.map(_polyfill, parts, [resolution] * len(parts)))
+        for part_cells in filled:
+            cells.update(part_cells)
+        record["rows"] = len(cells)
+    grid = HexGrid(np.array(sorted(cells), dtype="uint64"))
+    if lazy:
+        return grid
+    return grid.to_geodataframe()
+
+
+def h3_from_coordinates(resolution, size, x=0, y=0, crs_type="osgb", lazy=False):
     """takes a H3 resolution and grid size, and generates an appropriate H3 hex grid as a geodataframe. Will default
     to an OSGB CRS at coordinate 0,0, but can be given any option or convert to lat_lon by setting crs_type to
-    'lat_lon' """
+    'lat_lon'. Set lazy to get an id-only HexGrid instead of polygons """
 
     df = pd.DataFrame(index=[0], data={"city": "all", "y": y, "x": x})
     london = geopandas.GeoDataFrame(
@@ -53,20 +198,11 @@ def h3_from_coordinates(resolution, size, x=0, y=0, crs_type="osgb"):
         buffered = buffered.to_crs("EPSG:4326")
     lon_buffer = buffered.dissolve(by="city")
 
-    hexs = h3.polyfill(lon_buffer.iloc[0]["geometry"].__geo_interface__, resolution, geo_json_conformant=True)
-
-    polygonise = lambda hex_id: Polygon(
-        h3.h3_to_geo_boundary(
-            hex_id, geo_json=True)
-    )
-    all_polys = geopandas.GeoSeries(list(map(polygonise, hexs)),
-                                    index=hexs
-                                    )
-    london_hex = geopandas.GeoDataFrame(data=all_polys, columns=["geometry"]).reset_index().rename(
-        columns={"index": "h3_ref"})
-
-    london_hex = london_hex.set_crs("EPSG:4326")
-    if crs_type == "osgb":
-        london_hex = london_hex.to_crs("EPSG:27700")
+    with stage("polyfill") as record:
+        hexs = h3.polyfill(lon_buffer.iloc[0]["geometry"].__geo_interface__, resolution, geo_json_conformant=True)
+        record["rows"] = len(hexs)
+    london_hex = HexGrid.from_refs(hexs, "EPSG:27700" if crs_type == "osgb" else "EPSG:4326")
+    if lazy:
+        return london_hex
 
-    return london_hex
+    return london_hex.to_geodataframe()
@@ -0,0 +1,116 @@
+import json
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+from spatial_helper.ingest import _as_grid, _points_in_grid
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+class SpaceTimeCube:
+    """point counts indexed by hex x hour of day x day of week, and optionally x week, held either in a
+    memory-mapped .npy file or as a hex by time-slot scipy sparse matrix, so that any time window is a slice and sum
+    of the counts """
+
+    def __init__(self, counts, refs, grid_ref="h3_ref", first_week=None, shape=None):
+        self.counts = counts
+        self.refs = pd.Index(refs, name=grid_ref)
+        self.first_week = first_week
+        self.shape = tuple(counts.shape) if shape is None else tuple(shape)
+
+    @property
+    def is_sparse(self):
+        return self.counts.ndim == 2 and len(self.shape) > 2
+
+    @classmethod
+    def load(cls, path):
+        """opens a cube written by build_cube, without reading the counts into memory for a dense cube"""
+
+        with open(path + ".json") as sidecar:
+            meta = json.load(sidecar)
+        if meta.get("sparse"):
+            from scipy import sparse
+
+            with open(path, "rb") as stored:
+                counts = sparse.load_npz(stored).tocsr()
+        else:
+            counts = np.load(path, mmap_mode="r")
+        return cls(counts, meta["refs"], meta["grid_ref"], meta["first_week"], meta.get("shape"))
+
+    def window(self, hours=None, weekdays=None, weeks=None):
+        """returns the count per hex over the given hours (0-23), weekdays (0 is Monday) and week numbers, each
+        defaulting to all of them """
+
+        if self.is_sparse:
+            selected = np.ones(self.shape[1:], dtype=bool)
+            for axis, chosen in ((0, hours), (1, weekdays), (2, weeks)):
+                if chosen is not None and axis < selected.ndim:
+                    mask = np.zeros(self.shape[axis + 1], dtype=bool)
+                    mask[list(chosen)] = True
+                    selected &= mask.reshape([-1 if dim == axis else 1 for dim in range(selected.ndim)])
+            totals = np.asarray(self.counts[:, np.flatnonzero(selected.ravel())].sum(axis=1)).ravel()
+            return pd.Series(totals, index=self.refs, name="count")
+        selection = self.counts
+        for axis, chosen in ((1, hours), (2, weekdays), (3, weeks)):
+            if chosen is not None and axis < selection.ndim:
+                selection = np.take(selection, list(chosen), axis=axis)
+        totals = selection.sum(axis=tuple(range(1, selection.ndim)))
+        return pd.Series(totals, index=self.refs, name="count")
+
+    def to_sparse(self):
+        """returns the counts as a hex by time-slot scipy sparse matrix"""
+
+        from scipy import sparse
+
+        if self.is_sparse:
+            return self.counts
+        return sparse.csr_matrix(np.asarray(self.counts).reshape(len(self.refs), -1))
+
+
+def build_cube(points, grid, path, grid_ref="h3_ref", method="h3", time_col="IncidentTime", start=0,
+               date_col="IncidentDate", date_format=None, by_week=False, sparse=False):
+    """takes a frame of points and a grid and builds a space-time cube in one pass, written to path as a .npy file
+    with a .json sidecar of hex refs. Hours are read from time_col as elsewhere in ingest (for CRIS use
+    time_col="SUPV_CR_Recorded_Date", start=8) and days from date_col. by_week adds a week axis from the first week
+    in the data. Only the occupied cells are counted in memory, so a dense cube never has to fit in RAM, and with
+    sparse set the cube is written as a scipy sparse .npz of hex by time slot instead """
+
+    grid = _as_grid(grid, method)
+    if method == "sjoin" and points.crs != grid.crs:
+        points = points.set_crs(grid.crs, allow_override=True)
+    refs = pd.Index(grid[grid_ref])
+    assigned = _points_in_grid(points, grid, grid_ref, method)
+    dates = pd.to_datetime(assigned[date_col], format=date_format, errors="coerce")
+    hex_index = refs.get_indexer(assigned[grid_ref])
+    keep = (hex_index >= 0) & dates.notna().to_numpy()
+    hex_index = hex_index[keep]
+    hours = assigned[time_col].str.slice(start, start + 2).astype("int").to_numpy()[keep]
+    dates = dates[keep]
+    weekdays = dates.dt.dayofweek.to_numpy()
+    shape = [len(refs), 24, 7]
+    slot = (hex_index * 24 + hours) * 7 + weekdays
+    first_week = None
+    if by_week:
+        monday = (dates - pd.to_timedelta(dates.dt.dayofweek, unit="D")).dt.normalize()
+        first_week = monday.min() if len(monday) else pd.Timestamp.now().normalize()
+        week = ((monday - first_week).dt.days // 7).to_numpy()
+        shape.append(int(week.max()) + 1 if len(week) else 1)
+        slot = slot * shape[3] + week
+        first_week = first_week.strftime("%Y-%m-%d")
+    occupied, occupied_counts = np.unique(slot, return_counts=True)
+    if sparse:
+        from scipy import sparse as sp
+
+        slots = int(np.prod(shape[1:]))
+        counts = sp.csr_matrix((occupied_counts.astype("uint32"), (occupied // slots, occupied % slots)),
+                               shape=(len(refs), slots))
+        with open(path, "wb") as stored:
+            sp.save_npz(stored, counts)
+    else:
+        counts = open_memmap(path, mode="w+", dtype="uint32", shape=tuple(shape))
+        counts.reshape(-1)[occupied] = occupied_counts
+        counts.flush()
+    with open(path + ".json", "w") as sidecar:
+        json.dump({"refs": refs.astype(str).to_list(), "grid_ref": grid_ref, "first_week": first_week,
+                   "shape": shape, "sparse": sparse}, sidecar)
+    return SpaceTimeCube(counts, refs, grid_ref, first_week, shape)
@@ -1,16 +1,85 @@
+import html
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import branca.colormap
 import folium
 import geopandas
+import numpy as np
+import pandas as pd
+import shapely
+from branca.element import MacroElement
+from folium.elements import JSCSSMixin
+from jinja2 import Template
+from spatial_helper.create import HexGrid, add_h3_geometry
+from spatial_helper.instrument import stage
 
+TOOLTIP_STYLE = "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
 
-def generate_map(geoframe, category, key, top_count=50, tileset='CartoDB positron'):
-    """takes a geoframe coded to lat-long, a category to score by, and optionally a number of hexes to display,
-    and produces an interactive map """
+
+def quantise(geoframe, precision=5):
+    """rounds every coordinate of a geoframe to a number of decimal places (5 is about a metre in lat-long), which
+    shrinks the GeoJSON written into a map """
+
+    quantised = geoframe.copy()
+    quantised["geometry"] = shapely.transform(geoframe.geometry.values.data, lambda coords: np.round(coords, precision))
+    return quantised
+
+
+def _colour_scale(values):
+    """returns the six step BuPu colour scale that folium.Choropleth would use for a set of values"""
+
+    low, high = float(np.nanmin(values)), float(np.nanmax(values))
+    if high <= low:
+        high = low + 1
+    return branca.colormap.linear.BuPu_09.scale(low, high).to_step(6)
+
+
+def _single_layer_map(shown, values, category, fields, aliases, tileset, name='Custom Map'):
+    """draws the fill and the tooltip from one GeoJson layer, so each feature is written into the map only once"""
+
+    colours = _colour_scale(values)
+    map_osm = folium.Map(location=[51.5074, 0.1278], tiles=tileset)
+    layer = folium.features.GeoJson(
+        shown,
+        name=name,
+        style_function=lambda x: {'fillColor': colours(x["properties"][category]),
+                                  'color': '#000000',
+                                  'fillOpacity': 0.6,
+                                  'weight': 0.1},
+        highlight_function=lambda x: {'fillColor': '#000000',
+                                      'color': '#000000',
+                                      'fillOpacity': 0.50,
+                                      'weight': 0.1},
+        tooltip=folium.features.GeoJsonTooltip(fields=fields, aliases=aliases, style=TOOLTIP_STYLE)
+    )
+    map_osm.add_child(layer)
+    colours.caption = category
+    map_osm.add_child(colours)
+    folium.LayerControl().add_to(map_osm)
+    return map_osm
+
+
+def generate_map(geoframe, category, key, top_count=50, tileset='CartoDB positron', precision=None, compact=False):
+    """takes a geoframe coded to lat-long, a category to score by, and optionally a number of hexes to display (None
+    for all), and produces an interactive map. A plain frame of h3 refs gets polygons built for the displayed hexes
+    only. precision rounds coordinates to that many decimal places, and compact draws the fill and tooltip from a
+    single layer so each hex is written once """
+
+    shown = geoframe.sort_values(by=category, ascending=False).iloc[0:top_count]
+    if "geometry" not in shown.columns:
+        shown = add_h3_geometry(shown, key)
+    if precision is not None:
+        shown = quantise(shown, precision)
+    if compact:
+        return _single_layer_map(shown[[key, "geometry", category]], geoframe[category], category, [key, category],
+                                 ['CAD Grid Ref: ', 'Score'], tileset)
 
     # Create interactive map with default basemap
     map_osm = folium.Map(location=[51.5074, 0.1278], tiles=tileset)
 
     heat = folium.Choropleth(
-        geo_data=geoframe[[key, "geometry", category]].sort_values(by=category, ascending=False).iloc[0:top_count],
+        geo_data=shown[[key, "geometry", category]],
         name='Custom Map',
         data=geoframe,
         columns=[key, category],
@@ -28,14 +97,14 @@ def generate_map(geoframe, category, key, top_count=50, tileset='CartoDB positro
                                     'fillOpacity': 0.50,
                                     'weight': 0.1}
     nil = folium.features.GeoJson(
-        geoframe[[key, "geometry", category]].sort_values(by=category, ascending=False).iloc[0:top_count],
+        shown[[key, "geometry", category]],
         style_function=style_function,
         control=False,
         highlight_function=highlight_function,
         tooltip=folium.features.GeoJsonTooltip(
             fields=[key, category],
             aliases=['CAD Grid Ref: ', 'Score'],
-            style="background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+            style=TOOLTIP_STYLE
         )
     )
     map_osm.add_child(nil)
@@ -45,15 +114,25 @@ def generate_map(geoframe, category, key, top_count=50, tileset='CartoDB positro
     return map_osm
 
 
-def generate_cust_map(geoframe, category, key, top_count=50, values_to_show=[], tileset='CartoDB positron'):
+def generate_cust_map(geoframe, category, key, top_count=50, values_to_show=[], tileset='CartoDB positron',
+                      precision=None, compact=False):
     """takes a geoframe coded to lat-long, a category to score by, an optional list of dispays and other values to
-    highlight on tooltip, and produces an interactive map """
+    highlight on tooltip, and produces an interactive map. precision and compact shrink the map as in generate_map """
+
+    shown = geoframe.sort_values(by=category, ascending=False).iloc[0:top_count]
+    if "geometry" not in shown.columns:
+        shown = add_h3_geometry(shown, key)
+    if precision is not None:
+        shown = quantise(shown, precision)
+    if compact:
+        return _single_layer_map(shown[[key, "geometry", category] + values_to_show], geoframe[category], category,
+                                 [key, category] + values_to_show, ['Ref', 'Score'] + values_to_show, tileset)
 
     # Create interactive map with default basemap
     map_osm = folium.Map(location=[51.5074, 0.1278], tiles=tileset)
 
     heat = folium.Choropleth(
-        geo_data=geoframe[[key, "geometry", category]].sort_values(by=category, ascending=False).iloc[0:top_count],
+        geo_data=shown[[key, "geometry", category]],
         name='Custom Map',
         data=geoframe,
         columns=[key, category],
@@ -71,15 +150,14 @@ def generate_cust_map(geoframe, category, key, top_count=50, values_to_show=[],
                                     'fillOpacity': 0.50,
                                     'weight': 0.1}
     nil = folium.features.GeoJson(
-        geoframe[[key, "geometry", category] + values_to_show].sort_values(by=category, ascending=False).iloc[
-        0:top_count],
+        shown[[key, "geometry", category] + values_to_show],
         style_function=style_function,
         control=False,
         highlight_function=highlight_function,
         tooltip=folium.features.GeoJsonTooltip(
             fields=[key, category] + values_to_show,
             aliases=['Ref', 'Score'] + values_to_show,
-            style="background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+            style=TOOLTIP_STYLE
         )
     )
     map_osm.add_child(nil)
@@ -89,16 +167,82 @@ def generate_cust_map(geoframe, category, key, top_count=50, values_to_show=[],
     return map_osm
 
 
-def make_bcu_map(wards, hexes, geodata, bcu_name, tileset='CartoDB positron'):
-    """given a set of wards, hex data, and a geodata output, and a bcu name, returns a map of the BCU and a csv of
-    the table with ward data """
+class H3Layer(JSCSSMixin, MacroElement):
+    """a map layer that ships only h3 refs, values and colour bins, and draws the hexagon outlines in the browser
+    with h3-js """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var data = {{ this.data }};
+            var layer = L.featureGroup();
+            for (var i = 0; i < data.refs.length; i++) {
+                var tooltip = data.aliases[0] + " " + data.refs[i];
+                for (var j = 0; j < data.values.length; j++) {
+                    tooltip += "<br>" + data.aliases[j + 1] + " " + data.values[j][i];
+                }
+                L.polygon(h3.cellToBoundary(data.refs[i]), {
+                    color: "#000000", weight: 0.1, fillOpacity: 0.6,
+                    fillColor: data.palette[data.bins[i]]
+                }).bindTooltip(tooltip).addTo(layer);
+            }
+            layer.addTo({{ this._parent.get_name() }});
+        })();
+        {% endmacro %}
+    """)
+
+    default_js = [("h3-js", "https://unpkg.com/h3-js@4.1.0/dist/h3-js.umd.js")]
+
+    def __init__(self, refs, bins, palette, values, aliases):
+        super().__init__()
+        self._name = "H3Layer"
+        self.data = json.dumps({"refs": list(refs), "bins": list(bins), "palette": list(palette), "values": values,
+                                "aliases": aliases}, separators=(",", ":"))
 
-    bcu_map = geodata[(geodata["Previous entries"] < 2) & (geodata["BCU_Name"] == bcu_name)].reset_index().rename(
-        columns={"index": "Rank"})
-    geomap = bcu_map.merge(hexes, how="left", left_on="h3_ref", right_on="h3_ref").drop_duplicates()
+
+def _tooltip_values(column):
+    """returns a column as a list for a tooltip, rounding numbers to 2 places and passing anything else as text"""
+
+    if pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+        return np.round(column.to_numpy(dtype="float64"), 2).tolist()
+    return [html.escape(str(value)) for value in column]
+
+
+def generate_h3_map(frame, category, key="h3_ref", top_count=None, values_to_show=[], tileset='CartoDB positron'):
+    """takes a frame of h3 refs and a category to score by, and produces an interactive map that carries no polygons
+    at all: the hexagons are drawn client side from their refs, so every hex can be shown in a small file """
+
+    shown = frame.sort_values(by=category, ascending=False).iloc[0:top_count]
+    colours = _colour_scale(frame[category])
+    bins = np.clip(np.searchsorted(colours.index, shown[category].to_numpy(), side="right") - 1, 0,
+                   len(colours.colors) - 1)
+    palette = [colours(colours.index[step])[:7] for step in range(len(colours.colors))]
+    values = [_tooltip_values(shown[column]) for column in [category] + values_to_show]
+    map_osm = folium.Map(location=[51.5074, 0.1278], tiles=tileset, prefer_canvas=True)
+    map_osm.add_child(H3Layer(shown[key].astype(str), bins.tolist(), palette, values,
+                              ['Ref', 'Score'] + values_to_show))
+    colours.caption = category
+    map_osm.add_child(colours)
+    return map_osm
+
+
+def _bcu_geomap(geodata, hexes):
+    """ranks the hexes in a geodata output that have fewer than two previous entries and attaches their polygons"""
+
+    bcu_map = geodata[geodata["Previous entries"] < 2].reset_index().rename(columns={"index": "Rank"})
+    if isinstance(hexes, HexGrid):
+        geomap = add_h3_geometry(bcu_map[bcu_map["h3_ref"].isin(hexes.h3_ref)], "h3_ref", hexes.crs)
+    else:
+        geomap = bcu_map.merge(hexes, how="left", left_on="h3_ref", right_on="h3_ref").drop_duplicates()
     geomap["Rank"] = geomap["Rank"] + 1
-    geomap = geopandas.GeoDataFrame(
-        geomap[["Rank", "h3_ref", "BCU_Name", "t_centre_name", "Final_score", "geometry"]].dropna(axis=0).copy())
+    return geopandas.GeoDataFrame(
+        geomap[["Rank", "h3_ref", "BCU_Name", "t_centre_name", "Final_score", "geometry"]].dropna(axis=0).reset_index(
+            drop=True))
+
+
+def _render_bcu(bcu_name, geomap, hex_with_ward, output_dir, tileset='CartoDB positron'):
+    """writes the map and the ward table of one BCU to the output directory"""
+
     map_osm = folium.Map(location=[51.5074, 0.1278], tiles=tileset)
     heat = folium.Choropleth(
         geo_data=geomap,
@@ -126,12 +270,47 @@ def make_bcu_map(wards, hexes, geodata, bcu_name, tileset='CartoDB positron'):
         tooltip=folium.features.GeoJsonTooltip(
             fields=["h3_ref", "t_centre_name", "Final_score"],
             aliases=['Grid Ref', "Town Centre", 'Score'],
-            style="background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
+            style=TOOLTIP_STYLE
         )
     )
     map_osm.add_child(nil)
     map_osm.keep_in_front(nil)
     folium.LayerControl().add_to(map_osm)
-    map_osm.save("../data/map_output/" + bcu_name + "_map.html")
+    os.makedirs(output_dir, exist_ok=True)
+    map_path = os.path.join(output_dir, bcu_name + "_map.html")
+    table_path = os.path.join(output_dir, bcu_name + "_map.csv")
+    with stage("render_bcu", len(geomap)):
+        map_osm.save(map_path)
+        hex_with_ward.to_csv(table_path)
+    return map_path, table_path
+
+
+def make_bcu_map(wards, hexes, geodata, bcu_name, tileset='CartoDB positron', output_dir="../data/map_output/"):
+    """given a set of wards, hex data, and a geodata output, and a bcu name, returns a map of the BCU and a csv of
+    the table with ward data. hexes can be an id-only HexGrid, in which case only the BCU's polygons are built """
+
+    geomap = _bcu_geomap(geodata[geodata["BCU_Name"] == bcu_name], hexes)
     hex_with_ward = geopandas.sjoin(geomap, wards, how="left", op='intersects')
-    hex_with_ward.to_csv("../data/map_output/" + bcu_name + "_map.csv")
+    _render_bcu(bcu_name, geomap, hex_with_ward, output_dir, tileset)
+
+
+def make_bcu_maps(wards, hexes, geodata, output_dir="../data/map_output/", bcu_names=None, workers=None,
+                  tileset='CartoDB positron'):
+    """makes the map and ward table of every BCU in one pass: the hex merge and ward join are done once, split by
+    BCU_Name, and each BCU is rendered and written in a pool of worker processes (None uses every core, 1 runs in
+    this process). Each BCU's rows are indexed from 0, so the files match make_bcu_map's. Returns the paths
+    written """
+
+    with stage("bcu_join", len(geodata)):
+        geomap = _bcu_geomap(geodata, hexes)
+        geomap.index = geomap.groupby("BCU_Name").cumcount().to_numpy()
+        hex_with_ward = geopandas.sjoin(geomap, wards, how="left", op='intersects')
+    if bcu_names is None:
+        bcu_names = sorted(geomap["BCU_Name"].unique())
+    bcu_maps = dict(tuple(geomap.groupby("BCU_Name")))
+    bcu_wards = dict(tuple(hex_with_ward.groupby("BCU_Name")))
+    jobs = [(name, bcu_maps[name], bcu_wards[name], output_dir, tileset) for name in bcu_names if name in bcu_maps]
+    if workers == 1 or len(jobs) < 2:
+        return [_render_bcu(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_render_bcu, *zip(*jobs)))
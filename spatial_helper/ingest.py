@@ -1,40 +1,196 @@
+import hashlib
 import os
+import re
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 import geopandas
+import numpy as np
 import pandas as pd
+import shapely
+from h3 import h3
+from pyproj import Transformer
+from spatial_helper.cache import read_tab
+from spatial_helper.create import HexGrid
+from spatial_helper.instrument import logger, stage
 
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        from h3.unstable import vect as h3_vect
+except ImportError:
+    h3_vect = None
 
-def calc_cchi(lon_hex, crime_file, cchi_lookup, minor_class):
-    """calculcates CCCHI from an individual CRIS file"""
+HOUR_COLUMNS = ["hour_" + str(hour) for hour in range(24)]
+CAD_COLUMNS = ["IncidentNumber", "IncidentTime", "OpeningCode_Description", "X", "Y", "geometry"]
+CRIS_COLUMNS = ["CRNumber", "SUPV_CR_Recorded_Date", "X", "Y", "geometry"]
+CAD_CATEGORIES = {"Police Generated Res": "_violence", "ASB Nuisance": "_asb_nuisance",
+                  "Violence Against The": "_VAP"}
+TIME_HOURS = {"day": range(6, 20), "night": [hour for hour in range(24) if hour > 19 or hour < 6]}
 
-    if lon_hex.crs != crime_file.crs:
+
+def points_to_h3(points, resolution, x_col="X", y_col="Y", crs="EPSG:27700"):
+    """takes a frame of points and a h3 resolution, and returns the h3 cell of every point as a uint64 array. Uses
+    the OSGB X/Y columns where present, otherwise the point geometry, and never builds a polygon """
+
+    lat, lon = _points_lat_lon(points, x_col, y_col, crs)
+    return _lat_lon_to_h3(lat, lon, resolution)
+
+
+def _points_lat_lon(points, x_col="X", y_col="Y", crs="EPSG:27700"):
+    """returns the latitude and longitude arrays of a frame of points, reprojecting the X/Y columns or geometry"""
+
+    if x_col in points.columns and y_col in points.columns:
+        x = points[x_col].to_numpy(dtype="float64")
+        y = points[y_col].to_numpy(dtype="float64")
+    else:
+        x = points.geometry.x.to_numpy()
+        y = points.geometry.y.to_numpy()
+        if points.crs is not None:
+            crs = points.crs
+    with stage("reproject", len(x)):
+        lon, lat = Transformer.from_crs(crs, "EPSG:4326", always_xy=True).transform(x, y)
+    return lat, lon
+
+
+def _lat_lon_to_h3(lat, lon, resolution):
+    """returns the h3 cell of every latitude and longitude as a uint64 array"""
+
+    with stage("h3_index", len(lat)):
+        if h3_vect is not None:
+            return h3_vect.geo_to_h3(lat, lon, resolution)
+        return np.array([h3.string_to_h3(h3.geo_to_h3(la, lo, resolution)) for la, lo in zip(lat, lon)],
+                        dtype="uint64")
+
+
+def h3_grid_refs(points, grid, grid_ref):
+    """takes a frame of points and a h3 grid, and returns the grid reference of every point as a categorical,
+    with points falling outside the grid left as NaN """
+
+    refs = grid[grid_ref]
+    if refs.empty or not h3.h3_is_valid(str(refs.iloc[0])):
+        raise ValueError("The h3 method needs a grid referenced by h3 cell ids")
+    cells = points_to_h3(points, h3.h3_get_resolution(refs.iloc[0]))
+    uniq, inverse = np.unique(cells, return_inverse=True)
+    uniq_refs = pd.Index([h3.h3_to_string(int(c)) for c in uniq])
+    in_grid = uniq_refs.isin(refs)
+    positions = np.cumsum(in_grid) - 1
+    codes = np.where(in_grid[inverse], positions[inverse], -1)
+    return pd.Categorical.from_codes(codes, categories=uniq_refs[in_grid])
+
+
+def _as_grid(grid, method="sjoin"):
+    """turns an id-only HexGrid into a frame the aggregators can merge against, only building polygons when the
+    method needs a spatial join """
+
+    if isinstance(grid, HexGrid):
+        return grid.to_frame() if method == "h3" else grid.to_geodataframe()
+    return grid
+
+
+def _comparable(points):
+    """returns the points as a plain frame with the geometry swapped for its WKB, so rows can be compared"""
+
+    if "geometry" not in points.columns:
+        return pd.DataFrame(points)
+    return pd.DataFrame(points.drop(columns="geometry")).assign(_wkb=shapely.to_wkb(points.geometry.to_numpy()))
+
+
+def _drop_duplicate_points(points):
+    """drops exact duplicate rows, comparing geometries by their WKB, as the sjoin path's drop_duplicates does"""
+
+    return points[~_comparable(points).duplicated().to_numpy()]
+
+
+def _points_in_grid(points, grid, grid_ref, method="sjoin", dedupe=True):
+    """assigns points to a grid, either with a spatial join against the grid polygons or, for h3 grids, by
+    computing each point's cell directly. dedupe drops exact duplicate rows, which exports repeat """
+
+    if method == "h3":
+        if dedupe:
+            points = _drop_duplicate_points(points)
+        return points.assign(**{grid_ref: h3_grid_refs(points, grid, grid_ref)})
+    if method != "sjoin":
+        raise ValueError("Incorrect method - please chose sjoin or h3")
+    with stage("sjoin", len(points)):
+        joined = geopandas.sjoin(points, grid, how="left", op='within')
+        if dedupe:
+            joined = joined.drop_duplicates()
+    return joined
+
+
+def calc_cchi(lon_hex, crime_file, cchi_lookup, minor_class, method="sjoin"):
+    """calculcates CCCHI from an individual CRIS file. Set method to 'h3' to bin points by their h3 cell instead of
+    a spatial join """
+
+    lon_hex = _as_grid(lon_hex, method)
+    if method == "sjoin" and lon_hex.crs != crime_file.crs:
         crime_file = crime_file.set_crs(lon_hex.crs, allow_override=True)
-    crime_per_grid = geopandas.sjoin(crime_file, lon_hex, how="left", op='within').drop_duplicates()
-    crime_hex_cnt = crime_per_grid[["h3_ref", "CRNumber"]].groupby("h3_ref").count().reset_index()
-    lon_count = lon_hex.merge(crime_hex_cnt, how="left", on="h3_ref").fillna(0)
+    crime_per_grid = _points_in_grid(crime_file, lon_hex, "h3_ref", method)
+    with stage("calc_cchi.aggregate", len(crime_per_grid)):
+        crime_hex_cnt = crime_per_grid[["h3_ref", "CRNumber"]].groupby("h3_ref", observed=True).count(
+        ).reset_index()
+        lon_count = lon_hex.merge(crime_hex_cnt, how="left", on="h3_ref").fillna(0)
     lon_count["CCHI_score"] = lon_count["CRNumber"] * float(
         cchi_lookup.loc[cchi_lookup["cris_minor"] == minor_class, "CrimeHarm"])
-    print(lon_count["CCHI_score"].sum())
+    logger.info("CCHI total for %s: %s", minor_class, lon_count["CCHI_score"].sum())
     return lon_count[["h3_ref", "CCHI_score"]].fillna(0)
 
 
-def os_poi_to_hex(os_items, hexes):
+def calc_cchi_batch(lon_hex, crimes, cchi_lookup, class_col="minor_class", method="sjoin", matrix=False):
+    """calculates CCHI across every minor class in one combined CRIS frame, assigning hexes once and looking up the
+    harm weights in one vectorised map. Returns the CCHI_score per hex, and with matrix set also a hex by class
+    sparse matrix of scores and the list of classes for its columns """
+
+    lon_hex = _as_grid(lon_hex, method)
+    if method == "sjoin" and lon_hex.crs != crimes.crs:
+        crimes = crimes.set_crs(lon_hex.crs, allow_override=True)
+    crime_per_grid = _points_in_grid(crimes[crimes["CRNumber"].notna()], lon_hex, "h3_ref", method)
+    weights = cchi_lookup.drop_duplicates(subset="cris_minor").set_index("cris_minor")["CrimeHarm"].astype("float")
+    harm = crime_per_grid[class_col].map(weights)
+    missing = crime_per_grid.loc[harm.isna(), class_col].unique()
+    if len(missing):
+        logger.warning("No CCHI weight for %s", ", ".join(str(name) for name in missing))
+    with stage("calc_cchi_batch.aggregate", len(crime_per_grid)):
+        crime_per_grid = crime_per_grid.assign(CCHI_score=harm.fillna(0))
+        scores = crime_per_grid.groupby("h3_ref", observed=True)["CCHI_score"].sum()
+        scores.index = scores.index.astype(object)
+        lon_count = lon_hex[["h3_ref"]].merge(scores, how="left", left_on="h3_ref", right_index=True).fillna(0)
+    logger.info("CCHI total: %s", lon_count["CCHI_score"].sum())
+    if not matrix:
+        return lon_count
+    from scipy import sparse
+
+    rows = pd.Index(lon_hex["h3_ref"]).get_indexer(crime_per_grid["h3_ref"])
+    classes = pd.Index(sorted(crime_per_grid[class_col].dropna().unique()))
+    columns = classes.get_indexer(crime_per_grid[class_col])
+    keep = (rows >= 0) & (columns >= 0)
+    class_matrix = sparse.coo_matrix((crime_per_grid["CCHI_score"].to_numpy()[keep], (rows[keep], columns[keep])),
+                                     shape=(len(lon_hex), len(classes))).tocsr()
+    class_matrix.eliminate_zeros()
+    return lon_count, class_matrix, classes.to_list()
+
+
+def os_poi_to_hex(os_items, hexes, method="sjoin"):
     """takes a hex grid and an OS file and retuyrns a count per grid"""
 
-    if os_items.crs != hexes.crs:
+    hexes = _as_grid(hexes, method)
+    if method == "sjoin" and os_items.crs != hexes.crs:
         os_items = os_items.to_crs(hexes.crs)
-    block_with_hex = geopandas.sjoin(os_items, hexes, how="left", op='within')
-    return block_with_hex[["h3_ref", "UNIQUE_REFERENCE_NUMBER"]].groupby(["h3_ref"]).count().reset_index()
+    block_with_hex = _points_in_grid(os_items, hexes, "h3_ref", method, dedupe=False)
+    return block_with_hex[["h3_ref", "UNIQUE_REFERENCE_NUMBER"]].groupby(["h3_ref"], observed=True).count(
+    ).reset_index()
 
 
-def osm_feat_to_hex(osm_items, grid, osm_type, category="type"):
+def osm_feat_to_hex(osm_items, grid, osm_type, category="type", method="sjoin"):
     """takes a list of OSM items, a grid, a type of item and optionally a key to filter by, and returns the grid by
     h3 """
 
-    if osm_items.crs != grid.crs:
+    grid = _as_grid(grid, method)
+    if method == "sjoin" and osm_items.crs != grid.crs:
         osm_items = osm_items.to_crs(grid.crs)
     subset = osm_items[osm_items[category] == osm_type].copy()
-    block_with_hex = geopandas.sjoin(subset, grid, how="left", op='within')
-    return block_with_hex[["h3_ref", "osm_id"]].groupby(["h3_ref"]).count().reset_index()
+    block_with_hex = _points_in_grid(subset, grid, "h3_ref", method, dedupe=False)
+    return block_with_hex[["h3_ref", "osm_id"]].groupby(["h3_ref"], observed=True).count().reset_index()
 
 
 def bcu_to_grid(bcu_borders, grid):
@@ -44,9 +200,7 @@ def bcu_to_grid(bcu_borders, grid):
     grid_bcu_cnt = grid_with_borough[["CAD_Ref", "BCU_Code"]].groupby(["CAD_Ref"]).count().sort_values(
         by=["BCU_Code"]).reset_index()
     more_than_bcu = grid_bcu_cnt[grid_bcu_cnt["BCU_Code"] > 1]["CAD_Ref"].unique()
-    all_cads = grid_bcu_cnt["CAD_Ref"].unique()
-    corrects_cad_cnt = [x for x in all_cads if x not in more_than_bcu]
-    correct = grid_with_borough[grid_with_borough["CAD_Ref"].isin(corrects_cad_cnt)].copy()
+    correct = grid_with_borough[~grid_with_borough["CAD_Ref"].isin(more_than_bcu)].copy()
     wrong = grid_with_borough[grid_with_borough["CAD_Ref"].isin(more_than_bcu)].copy()
     fixed = wrong.sample(frac=1, random_state=42).drop_duplicates(subset="CAD_Ref").copy()
     all_cads_with_bcu = pd.concat([correct, fixed], axis=0)
@@ -62,9 +216,7 @@ def overlap_to_grid(new_borders, identifier, grid, g_identifier):
     grid_bcu_cnt = grid_with_borough[[g_identifier, identifier]].groupby([g_identifier]).count().sort_values(
         by=[identifier]).reset_index()
     more_than_bcu = grid_bcu_cnt[grid_bcu_cnt[identifier] > 1][g_identifier].unique()
-    all_cads = grid_bcu_cnt[g_identifier].unique()
-    corrects_cad_cnt = [x for x in all_cads if x not in more_than_bcu]
-    correct = grid_with_borough[grid_with_borough[g_identifier].isin(corrects_cad_cnt)].copy()
+    correct = grid_with_borough[~grid_with_borough[g_identifier].isin(more_than_bcu)].copy()
     wrong = grid_with_borough[grid_with_borough[g_identifier].isin(more_than_bcu)].copy()
     fixed = wrong.sample(frac=1, random_state=42).drop_duplicates(subset=g_identifier).copy()
     all_cads_with_bcu = pd.concat([correct, fixed], axis=0)
@@ -72,21 +224,82 @@ def overlap_to_grid(new_borders, identifier, grid, g_identifier):
     return all_cads_with_bcu
 
 
-def crime_cad_grid(crime_df, grid, grid_ref, major_class):
+def _overlap_key(grid, g_identifier, borders, identifier):
+    """returns a hash of a grid and a set of borders, used to name cached overlap lookups"""
+
+    key = hashlib.sha1()
+    for frame, column in ((grid, g_identifier), (borders, identifier)):
+        key.update(pd.util.hash_pandas_object(frame[column].astype(str), index=False).to_numpy().tobytes())
+        key.update(b"".join(frame.geometry.to_wkb()))
+        key.update(str(frame.crs).encode("utf-8"))
+    return key.hexdigest()
+
+
+def overlap_weights(borders, identifier, grid, g_identifier, cache_dir=None):
+    """intersects a grid with a set of borders in one overlay pass and returns, for every grid cell and border it
+    touches, the intersection area and the cell's weight, its share of the cell's area inside the borders. Given a
+    cache directory the lookup is stored and reused for the same grid and borders """
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, "overlap_" + _overlap_key(grid, g_identifier, borders, identifier) + ".parquet")
+        if os.path.exists(path):
+            return pd.read_parquet(path)
+    if grid.crs is not None and grid.crs.is_geographic:
+        grid = grid.to_crs("EPSG:27700")
+    if borders.crs != grid.crs:
+        borders = borders.to_crs(grid.crs)
+    with stage("overlay", len(grid)):
+        pieces = geopandas.overlay(grid[[g_identifier, "geometry"]], borders[[identifier, "geometry"]],
+                                   how="intersection", keep_geom_type=True)
+    weights = pd.DataFrame({g_identifier: pieces[g_identifier], identifier: pieces[identifier],
+                            "area": pieces.geometry.area})
+    weights = weights.groupby([g_identifier, identifier], as_index=False)["area"].sum()
+    weights["weight"] = weights["area"] / weights.groupby(g_identifier)["area"].transform("sum")
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        weights.to_parquet(path, index=False)
+    return weights
+
+
+def largest_overlap_to_grid(new_borders, identifier, grid, g_identifier, cache_dir=None):
+    """as overlap_to_grid, but each grid cell goes to the border it has the largest share of its area in, with ties
+    going to the lowest identifier, so the result is the same on every run """
+
+    weights = overlap_weights(new_borders, identifier, grid, g_identifier, cache_dir)
+    lookup = weights.sort_values(by=[g_identifier, "area", identifier], ascending=[True, False, True]
+                                 ).drop_duplicates(subset=g_identifier)[[g_identifier, identifier]]
+    return grid.merge(lookup, how="inner", on=g_identifier).merge(
+        pd.DataFrame(new_borders.drop(columns="geometry")), how="left", on=identifier)
+
+
+def apportion_counts(counts, g_identifier, weights, identifier, columns):
+    """splits per-cell counts across borders by the fractional weights from overlap_weights and returns the totals
+    per border """
+
+    split = weights[[g_identifier, identifier, "weight"]].merge(counts[[g_identifier] + columns], on=g_identifier)
+    split[columns] = split[columns].multiply(split["weight"], axis=0)
+    return split.groupby(identifier, as_index=False)[columns].sum()
+
+
+def crime_cad_grid(crime_df, grid, grid_ref, major_class, method="sjoin"):
     """takes a crime df and a grid, grid reference column, and returns a count, median and mean per grid"""
 
-    if crime_df.crs != grid.crs:
+    grid = _as_grid(grid, method)
+    if method == "sjoin" and crime_df.crs != grid.crs:
         crime_df = crime_df.set_crs(grid.crs, allow_override=True)
     if "index_right" in crime_df.columns.to_list():
         crime_df = crime_df.drop(["index_right"], axis=1).copy()
     grid.rename(columns={grid_ref: "CAD_Ref"}, inplace=True)
-    crime_per_grid = geopandas.sjoin(crime_df, grid, how="left", op='within').drop_duplicates()
+    crime_per_grid = _points_in_grid(crime_df, grid, "CAD_Ref", method)
     crime_per_grid["hour"] = crime_per_grid["SUPV_CR_Recorded_Date"].str.slice(8, 10).astype("int")
-    crime_grid_median = crime_per_grid[["CAD_Ref", "CRNumber", "hour"]].groupby("CAD_Ref").agg(
-        {'CRNumber': ['count'], 'hour': ['mean', 'median']}).reset_index().rename(
-        columns={"index_right": "CAD_count"}).copy()
+    with stage("crime_cad_grid.groupby", len(crime_per_grid)):
+        crime_grid_median = crime_per_grid[["CAD_Ref", "CRNumber", "hour"]].groupby("CAD_Ref", observed=True).agg(
+            {'CRNumber': ['count'], 'hour': ['mean', 'median']}).reset_index().rename(
+            columns={"index_right": "CAD_count"}).copy()
     crime_grid_median.columns = ["CAD_Ref", "count", "mean_hr", "median_hr"]
-    crime_count_geo = grid.merge(crime_grid_median, how="left", left_on="CAD_Ref", right_on="CAD_Ref")
+    with stage("crime_cad_grid.merge", len(grid)):
+        crime_count_geo = grid.merge(crime_grid_median, how="left", left_on="CAD_Ref", right_on="CAD_Ref")
     crime_count_geo[["CAD_Ref", "count", "mean_hr", "median_hr"]] = crime_count_geo[
         ["CAD_Ref", "count", "mean_hr", "median_hr"]].fillna(0)
     crime_count_geo = crime_count_geo.rename(
@@ -96,34 +309,38 @@ def crime_cad_grid(crime_df, grid, grid_ref, major_class):
     return crime_count_geo
 
 
-def cad_to_grid(grid, grid_ref, cads):
+def cad_to_grid(grid, grid_ref, cads, method="sjoin"):
     """takes a geofile of grids, an index column name, and a grid and returns a count, median and mean per grid"""
 
-    if cads.crs != grid.crs:
+    grid = _as_grid(grid, method)
+    if method == "sjoin" and cads.crs != grid.crs:
         cads = cads.set_crs(grid.crs, allow_override=True)
     if "index_right" in cads.columns.to_list():
         cads = cads.drop(["index_right"], axis=1).copy()
     if "index_left" in cads.columns.to_list():
         cads = cads.drop(["index_left"], axis=1).copy()
     grid.rename(columns={grid_ref: "CAD_Ref"}, inplace=True)
-    cad_per_grid = geopandas.sjoin(cads, grid, how="left", op='within').drop_duplicates()
+    cad_per_grid = _points_in_grid(cads, grid, "CAD_Ref", method)
     cad_per_grid["hour"] = cad_per_grid["IncidentTime"].str.slice(0, 2).astype("int")
-    cad_grid_median = cad_per_grid[["CAD_Ref", "IncidentNumber", "hour"]].groupby("CAD_Ref").agg(
-        {'IncidentNumber': ['count'], 'hour': ['mean', 'median']}).reset_index().rename(
-        columns={"index_right": "CAD_count"}).copy()
+    with stage("cad_to_grid.groupby", len(cad_per_grid)):
+        cad_grid_median = cad_per_grid[["CAD_Ref", "IncidentNumber", "hour"]].groupby("CAD_Ref", observed=True).agg(
+            {'IncidentNumber': ['count'], 'hour': ['mean', 'median']}).reset_index().rename(
+            columns={"index_right": "CAD_count"}).copy()
     cad_grid_median.columns = ["CAD_Ref", "count", "mean_hr", "median_hr"]
-    cad_count_geo = grid.merge(cad_grid_median, how="left", left_on="CAD_Ref", right_on="CAD_Ref")
+    with stage("cad_to_grid.merge", len(grid)):
+        cad_count_geo = grid.merge(cad_grid_median, how="left", left_on="CAD_Ref", right_on="CAD_Ref")
     cad_count_geo[["CAD_Ref", "count", "mean_hr", "median_hr"]] = cad_count_geo[
         ["CAD_Ref", "count", "mean_hr", "median_hr"]].fillna(0)
     cad_count_geo.rename(columns={"CAD_Ref": grid_ref}, inplace=True)
     return cad_count_geo
 
 
-def cad_to_grid_time(grid, grid_ref, cads, time="day"):
+def cad_to_grid_time(grid, grid_ref, cads, time="day", method="sjoin"):
     """takes a geofile of grids, an index column name, and a grid and returns a count, as well as a time of day (
     0600-1900) or night. """
 
-    if cads.crs != grid.crs:
+    grid = _as_grid(grid, method)
+    if method == "sjoin" and cads.crs != grid.crs:
         cads = cads.set_crs(grid.crs, allow_override=True)
     if "index_right" in cads.columns.to_list():
         cads = cads.drop(["index_right"], axis=1).copy()
@@ -131,128 +348,296 @@ def cad_to_grid_time(grid, grid_ref, cads, time="day"):
         cads = cads.drop(["index_left"], axis=1).copy()
     grid.rename(columns={grid_ref: "CAD_Ref"}, inplace=True)
     cads["hour"] = cads["IncidentTime"].str.slice(0, 2).astype("int")
-    print(cads.shape[0])
+    logger.info("%d cads before the %s filter", cads.shape[0], time)
     if time == "day":
         cads = cads[(cads["hour"] <= 19) & (cads["hour"] >= 6)].copy()
     if time == "night":
-        cads = cads[(cads["hour"] > 19) & (cads["hour"] < 6)].copy()
-    print(cads.shape[0])
-    cad_per_grid = geopandas.sjoin(cads, grid, how="left", op='within').drop_duplicates()
-    cad_count = cad_per_grid[["CAD_Ref", "IncidentNumber"]].groupby("CAD_Ref").count().rename(
+        cads = cads[(cads["hour"] > 19) | (cads["hour"] < 6)].copy()
+    logger.info("%d cads after the %s filter", cads.shape[0], time)
+    cad_per_grid = _points_in_grid(cads, grid, "CAD_Ref", method)
+    cad_count = cad_per_grid[["CAD_Ref", "IncidentNumber"]].groupby("CAD_Ref", observed=True).count().rename(
         columns={"IncidentNumber": time + "_count"}).copy()
     cad_count_geo = grid.merge(cad_count, how="left", left_on="CAD_Ref", right_on="CAD_Ref")
     cad_count_geo[time + "_count"] = cad_count_geo[time + "_count"].fillna(0)
+    cad_count_geo.rename(columns={"CAD_Ref": grid_ref}, inplace=True)
     return cad_count_geo
 
 
-def cad_to_grid_cats(grid, grid_ref, cads):
-    """takes a  geofile , index column,  and returns a count, median and mean per grid"""
+def _category_suffix(code):
+    """turns an opening code description into a column suffix"""
 
-    if cads.crs != grid.crs:
+    return "_" + re.sub(r"[^0-9a-zA-Z]+", "_", code).strip("_").lower()
+
+
+def cad_to_grid_cats(grid, grid_ref, cads, method="sjoin", codes=CAD_CATEGORIES):
+    """takes a geofile, index column, and returns a count, median and mean per grid for each opening code in one
+    pass. codes can be a dict of opening code to column suffix, a list of opening codes, or None for every code in
+    the data """
+
+    grid = _as_grid(grid, method)
+    if method == "sjoin" and cads.crs != grid.crs:
         cads = cads.set_crs(grid.crs, allow_override=True)
     if "index_right" in cads.columns.to_list():
         cads = cads.drop(["index_right"], axis=1).copy()
     if "index_left" in cads.columns.to_list():
         cads = cads.drop(["index_left"], axis=1).copy()
-    grid.rename(columns={grid_ref: "CAD_Ref"}, inplace=True)
-    code_list = {"Police Generated Res": "_violence", "ASB Nuisance": "_asb_nuisance", "Violence Against The": "_VAP"}
-    for key in code_list:
-        cads = cads[cads["OpeningCode_Description"] == key].copy()
-        cad_per_grid = geopandas.sjoin(cads, grid, how="left", op='within').drop_duplicates()
-        cad_per_grid["hour"] = cad_per_grid["IncidentTime"].str.slice(0, 2).astype("int")
-        cad_grid_median = cad_per_grid[["CAD_Ref", "IncidentNumber", "hour"]].groupby("CAD_Ref").agg(
-            {'IncidentNumber': ['count'], 'hour': ['mean', 'median']}).reset_index().rename(
-            columns={"index_right": "CAD_count"}).copy()
-        cad_grid_median.columns = ["CAD_Ref", "count", "mean_hr", "median_hr"]
-        cad_count_geo = grid.merge(cad_grid_median, how="left", left_on="CAD_Ref", right_on="CAD_Ref")
-        cad_count_geo[["CAD_Ref", "count", "mean_hr", "median_hr"]] = cad_count_geo[
-            ["CAD_Ref", "count", "mean_hr", "median_hr"]].fillna(0).rename(
-            columns={"count": "count" + code_list[key], "mean_hr": "mean_hr" + code_list[key],
-                     "median_hr": "median_hr" + code_list[key]})
-        cad_count_geo.rename(columns={"CAD_Ref": grid_ref}, inplace=True)
-        return cad_count_geo
+    if codes is None:
+        codes = sorted(cads["OpeningCode_Description"].dropna().unique())
+    if not isinstance(codes, dict):
+        codes = {code: _category_suffix(code) for code in codes}
+    grid = grid.rename(columns={grid_ref: "CAD_Ref"})
+    cads = cads[cads["OpeningCode_Description"].isin(list(codes))]
+    cad_per_grid = _points_in_grid(cads, grid, "CAD_Ref", method)
+    cad_per_grid["hour"] = cad_per_grid["IncidentTime"].str.slice(0, 2).astype("int")
+    with stage("cad_to_grid_cats.groupby", len(cad_per_grid)):
+        cad_grid_median = cad_per_grid.groupby(["CAD_Ref", "OpeningCode_Description"], observed=True).agg(
+            count=("IncidentNumber", "count"), mean_hr=("hour", "mean"), median_hr=("hour", "median")).unstack()
+    columns = []
+    for key, suffix in codes.items():
+        for stat in ["count", "mean_hr", "median_hr"]:
+            columns.append(cad_grid_median[(stat, key)].rename(stat + suffix) if (stat, key) in cad_grid_median
+                           else pd.Series(dtype="float64", name=stat + suffix))
+    cad_grid_wide = pd.concat(columns, axis=1)
+    cad_grid_wide.index = cad_grid_wide.index.astype(object)
+    cad_count_geo = grid.merge(cad_grid_wide, how="left", left_on="CAD_Ref", right_index=True)
+    cad_count_geo[cad_grid_wide.columns.to_list()] = cad_count_geo[cad_grid_wide.columns.to_list()].fillna(0)
+    cad_count_geo.rename(columns={"CAD_Ref": grid_ref}, inplace=True)
+    return cad_count_geo
 
 
-def agg_cad_directory(directory, grid, grid_ref, exclude_shout=True):
+def iter_tab_chunks(path, chunksize=None, columns=None, cache_dir=None):
+    """reads a .tab file one chunk of rows at a time, so only a single chunk is ever held in memory. Without a
+    chunksize the whole file is returned as one chunk. With a cache directory the needed columns are loaded from the
+    columnar cache and then chunked """
+
+    if chunksize is None or cache_dir is not None:
+        frame = read_tab(path, columns, cache_dir)
+        if chunksize is None:
+            yield frame
+            return
+        for start in range(0, len(frame), chunksize):
+            yield frame.iloc[start:start + chunksize]
+        return
+    import fiona
+
+    with fiona.open(path) as source:
+        crs = source.crs or "EPSG:27700"
+        batch = []
+        for feature in source:
+            batch.append(feature)
+            if len(batch) >= chunksize:
+                yield geopandas.GeoDataFrame.from_features(batch, crs=crs)
+                batch = []
+        if batch:
+            yield geopandas.GeoDataFrame.from_features(batch, crs=crs)
+
+
+def hour_histogram(points, grid_ref, time_col="IncidentTime", start=0):
+    """takes points already assigned to a grid and returns per-hex partial statistics: the number of points in each
+    hour of the day. Histograms from separate files can be summed, and counts, hour sums and exact medians are all
+    recovered from the total """
+
+    with stage("hour_histogram", len(points)):
+        hours = points[time_col].str.slice(start, start + 2).astype("int")
+        histogram = points.groupby([points[grid_ref], hours], observed=True).size().unstack(fill_value=0)
+    histogram = histogram.reindex(columns=range(24), fill_value=0)
+    histogram.columns = HOUR_COLUMNS
+    histogram.index = histogram.index.astype(object)
+    histogram.index.name = grid_ref
+    return histogram
+
+
+def merge_histograms(total, histogram):
+    """adds a partial hour histogram onto a running total"""
+
+    if total is None:
+        return histogram
+    return total.add(histogram, fill_value=0).astype("int64")
+
+
+def hour_stats(histogram):
+    """turns per-hex hour histograms into the count, mean_hr and median_hr columns produced by cad_to_grid, with the
+    median matching pandas' median of the raw hours """
+
+    counts = histogram[HOUR_COLUMNS].to_numpy()
+    total = counts.sum(axis=1)
+    cumulative = counts.cumsum(axis=1)
+    lower = (cumulative < ((total + 1) // 2)[:, None]).sum(axis=1)
+    upper = (cumulative < (total // 2 + 1)[:, None]).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = counts @ np.arange(24) / total
+    return pd.DataFrame(index=histogram.index,
+                        data={"count": total, "mean_hr": mean, "median_hr": (lower + upper) / 2})
+
+
+def _exclude_shout(cads):
+    """drops the Op Shout concern for safety calls"""
+
+    return cads[~((cads["X"] == 523769) & (cads["Y"] == 180824) & (
+            cads["OpeningCode_Description"] == "Concern For Safety"))].copy()
+
+
+def _stream_cad_histogram(directory, grid, grid_ref, row_filter=None, method="sjoin", chunksize=None,
+                          cache_dir=None):
+    """streams every .tab file in a directory through a row filter and into one per-hex hour histogram, holding
+    only one chunk of raw rows in memory at a time. Exact duplicate rows are dropped across all the files, as the
+    batch path does, by keeping a sorted array of the 64-bit hashes of the rows already counted """
+
+    total = None
+    seen = np.empty(0, dtype="uint64")
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".tab"):
+            continue
+        logger.info("Processing file %s", filename)
+        for chunk in iter_tab_chunks(os.path.join(directory, filename), chunksize, CAD_COLUMNS, cache_dir):
+            chunk = chunk[[column for column in CAD_COLUMNS if column in chunk.columns]]
+            if row_filter is not None:
+                chunk = row_filter(chunk)
+            if chunk.empty:
+                continue
+            hashes = pd.util.hash_pandas_object(_comparable(chunk), index=False).to_numpy()
+            fresh = ~pd.Series(hashes).duplicated().to_numpy()
+            if len(seen):
+                found = np.clip(np.searchsorted(seen, hashes), 0, len(seen) - 1)
+                fresh &= seen[found] != hashes
+            chunk = chunk[fresh]
+            seen = np.union1d(seen, hashes[fresh])
+            if chunk.empty:
+                continue
+            if method == "sjoin" and chunk.crs != grid.crs:
+                chunk = chunk.set_crs(grid.crs, allow_override=True)
+            assigned = _points_in_grid(chunk, grid[[grid_ref, "geometry"]] if method == "sjoin" else grid, grid_ref,
+                                       method, dedupe=method == "sjoin")
+            total = merge_histograms(total, hour_histogram(assigned, grid_ref))
+    if total is None:
+        total = pd.DataFrame(columns=HOUR_COLUMNS, dtype="int64")
+    return total
+
+
+def _grid_with_stats(grid, grid_ref, stats):
+    """left joins per-hex statistics onto the grid, filling hexes with no points with 0"""
+
+    with stage("merge", len(grid)):
+        grid_stats = grid.merge(stats, how="left", left_on=grid_ref, right_index=True)
+        grid_stats[stats.columns.to_list()] = grid_stats[stats.columns.to_list()].fillna(0)
+    return grid_stats
+
+
+def agg_cad_directory(directory, grid, grid_ref, exclude_shout=True, method="sjoin", streaming=False,
+                      chunksize=None, cache_dir=None):
     """takes all cads in a directory, aggregates and returns a list of grids, and checks wheter you want to exclude
-    op shout """
+    op shout. With streaming set, files are aggregated one at a time (or chunksize rows at a time) in flat memory, and
+    with a cache_dir parsed files are kept in a columnar cache for later runs """
 
     if exclude_shout:
-        print("Op Shout Excluded, True")
+        logger.info("Op Shout Excluded, True")
+    if streaming:
+        grid = _as_grid(grid, method)
+        histogram = _stream_cad_histogram(directory, grid, grid_ref, _exclude_shout if exclude_shout else None,
+                                          method, chunksize, cache_dir)
+        return _grid_with_stats(grid, grid_ref, hour_stats(histogram))
     all_borough = []
     for filename in os.listdir(directory):
         if filename.endswith(".tab"):
-            print("Processing file " + filename)
-            filename = geopandas.read_file(directory + "\\" + filename, crs="EPSG:27700")
+            logger.info("Processing file %s", filename)
+            filename = read_tab(os.path.join(directory, filename), CAD_COLUMNS, cache_dir)
             if exclude_shout:
-                filename = filename[~((filename["X"] == 523769) & (filename["Y"] == 180824) & (
-                        filename["OpeningCode_Description"] == "Concern For Safety"))].copy()
+                filename = _exclude_shout(filename)
             all_borough.append(filename)
         else:
             continue
     all_borough_cads = pd.concat(all_borough, axis=0, ignore_index=True)
-    all_cads = cad_to_grid(grid, grid_ref, all_borough_cads)
+    all_cads = cad_to_grid(grid, grid_ref, all_borough_cads, method=method)
     return all_cads
 
 
-def agg_cad_directory_time(directory, grid, grid_ref, exclude_shout=True):
+def agg_cad_directory_time(directory, grid, grid_ref, exclude_shout=True, method="sjoin", time="day",
+                           streaming=False, chunksize=None, cache_dir=None):
     """takes all cads in a directory, aggregates and returns a list of grids v3, an optionally a function,
-    as well as exclude op shout """
+    as well as exclude op shout. With streaming set, files are aggregated one at a time in flat memory, and with a
+    cache_dir parsed files are kept in a columnar cache """
 
     all_borough = []
     if exclude_shout:
-        print("Op Shout Excluded, True")
+        logger.info("Op Shout Excluded, True")
+    if streaming:
+        grid = _as_grid(grid, method)
+        histogram = _stream_cad_histogram(directory, grid, grid_ref, _exclude_shout if exclude_shout else None,
+                                          method, chunksize, cache_dir)
+        time_count = histogram[["hour_" + str(hour) for hour in TIME_HOURS[time]]].sum(axis=1).to_frame(
+            time + "_count")
+        return _grid_with_stats(grid, grid_ref, time_count)
     for filename in os.listdir(directory):
         if filename.endswith(".tab"):
-            print("Processing file " + filename)
-            filename = geopandas.read_file(directory + "\\" + filename, crs="EPSG:27700")
+            logger.info("Processing file %s", filename)
+            filename = read_tab(os.path.join(directory, filename), CAD_COLUMNS, cache_dir)
             if exclude_shout:
-                filename = filename[~((filename["X"] == 523769) & (filename["Y"] == 180824) & (
-                        filename["OpeningCode_Description"] == "Concern For Safety"))].copy()
+                filename = _exclude_shout(filename)
             all_borough.append(filename)
         else:
             continue
     all_borough_cads = pd.concat(all_borough, axis=0, ignore_index=True)
-    all_cads = cad_to_grid_time(grid, grid_ref, all_borough_cads)
+    all_cads = cad_to_grid_time(grid, grid_ref, all_borough_cads, time=time, method=method)
     return all_cads
 
 
-def agg_cad_code_directory(directory, theme, suffix, grid, grid_ref):
+def agg_cad_code_directory(directory, theme, suffix, grid, grid_ref, method="sjoin", streaming=False,
+                           chunksize=None, cache_dir=None):
     """takes all cads in a directory, an opening code and a column name suffix, aggregates and returns a list of
-    grids v3 """
-
+    grids v3. With streaming set, files are aggregated one at a time in flat memory, and with a cache_dir parsed
+    files are kept in a columnar cache """
+
+    if streaming:
+        grid = _as_grid(grid, method)
+        histogram = _stream_cad_histogram(directory, grid, grid_ref,
+                                          lambda cads: cads[cads["OpeningCode_Description"] == theme], method,
+                                          chunksize, cache_dir)
+        return _grid_with_stats(grid, grid_ref, hour_stats(histogram)).rename(
+            columns={"count": "count" + "_" + suffix, "mean_hr": "mean_hr" + "_" + suffix,
+                     "median_hr": "median_hr" + "_" + suffix})
     all_borough = []
     for filename in os.listdir(directory):
         if filename.endswith(".tab"):
-            filename = geopandas.read_file(directory + "\\" + filename, crs="EPSG:27700")
+            filename = read_tab(os.path.join(directory, filename), CAD_COLUMNS, cache_dir)
             filename = filename[filename["OpeningCode_Description"] == theme].copy()
             all_borough.append(filename)
         else:
             continue
     all_borough_cads = pd.concat(all_borough, axis=0, ignore_index=True)
-    all_cads = cad_to_grid(grid, grid_ref, all_borough_cads).rename(
+    all_cads = cad_to_grid(grid, grid_ref, all_borough_cads, method=method).rename(
         columns={"count": "count" + "_" + suffix, "mean_hr": "mean_hr" + "_" + suffix,
                  "median_hr": "median_hr" + "_" + suffix})
     return all_cads
 
 
-def agg_cris_directory(directory, grid, grid_ref):
-    crime_names = []
-    for filename in os.listdir(directory):
+def _cris_class_grid(paths, grid, grid_ref, name, method="sjoin", cache_dir=None):
+    """reads every CRIS file of one major class and returns its count, mean and median hour per grid"""
+
+    logger.info("Processing major class %s", name)
+    all_borough = [read_tab(path, CRIS_COLUMNS, cache_dir) for path in paths]
+    all_borough_cads = pd.concat(all_borough, axis=0, ignore_index=True)
+    return crime_cad_grid(all_borough_cads, grid.copy(), grid_ref, name, method=method).iloc[:, -3:]
+
+
+def agg_cris_directory(directory, grid, grid_ref, method="sjoin", workers=None, cache_dir=None):
+    """takes all CRIS files in a directory, groups them by the major class at the start of the file name, and returns
+    a count, mean and median hour per grid for every class. Classes are parsed and aggregated in a pool of worker
+    processes, using every core unless a number of workers is given (1 runs in this process). Set cache_dir to keep
+    a columnar copy of each parsed file for later runs """
+
+    grid = _as_grid(grid, method)
+    crime_files = {}
+    for filename in sorted(os.listdir(directory)):
         if filename.endswith(".tab"):
             major_name = filename.split("_")[0].replace(" ", "")
-            if major_name not in crime_names:
-                crime_names.append(major_name)
-    all_crimes = []
-    for name in crime_names:
-        print(name)
-        all_borough = []
-        for filename in os.listdir(directory):
-            if filename.endswith(".tab"):
-                major_name = filename.split("_")[0].replace(" ", "")
-                if major_name == name:
-                    all_borough.append(geopandas.read_file(directory + "\\" + filename, crs="EPSG:27700"))
-        all_borough_cads = pd.concat(all_borough, axis=0, ignore_index=True)
-        all_crimes.append(crime_cad_grid(all_borough_cads, grid, grid_ref, name).iloc[:, -3:])
+            crime_files.setdefault(major_name, []).append(os.path.join(directory, filename))
+    if workers == 1 or len(crime_files) < 2:
+        all_crimes = [_cris_class_grid(paths, grid, grid_ref, name, method, cache_dir)
+                      for name, paths in crime_files.items()]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_cris_class_grid, paths, grid, grid_ref, name, method, cache_dir)
+                       for name, paths in crime_files.items()]
+            all_crimes = [future.result() for future in futures]
     all_things = pd.concat(all_crimes, axis=1)
     return all_things
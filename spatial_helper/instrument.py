@@ -0,0 +1,106 @@
+import atexit
+import cProfile
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger("spatial_helper")
+
+_settings = {"enabled": False, "memory": False, "sink": None, "profiler": None, "profile_path": None}
+_stack = []
+
+
+def enable(metrics_path=None, memory=False, profile_path=None, level=logging.INFO):
+    """switches on per-stage timing for this run. Each stage is logged to the spatial_helper logger and, given a
+    metrics path, appended to it as a JSON line, along with the process's peak RSS where the platform reports it.
+    memory also tracks each stage's own peak through tracemalloc, which slows the stages it measures, and
+    profile_path runs cProfile until disable is called and writes its stats there """
+
+    _settings.update(enabled=True, memory=memory, sink=metrics_path, profile_path=profile_path)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if profile_path is not None:
+        _settings["profiler"] = cProfile.Profile()
+        _settings["profiler"].enable()
+
+
+def disable():
+    """switches stage timing off, stopping memory tracing and writing out any profile"""
+
+    if _settings["profiler"] is not None:
+        _settings["profiler"].disable()
+        _settings["profiler"].dump_stats(_settings["profile_path"])
+    if _settings["memory"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _settings.update(enabled=False, memory=False, sink=None, profiler=None, profile_path=None)
+
+
+@contextmanager
+def stage(name, rows=None):
+    """times a stage of work. The yielded dict can be given the number of rows processed once it is known. While
+    instrumentation is disabled the dict is yielded and nothing else is done """
+
+    record = {"stage": name, "rows": rows}
+    if not _settings["enabled"]:
+        yield record
+        return
+    if _settings["memory"]:
+        current, peak = tracemalloc.get_traced_memory()
+        if _stack:
+            _stack[-1]["_child_peak"] = max(_stack[-1].get("_child_peak", 0), peak)
+        record["_start_mb"] = current
+        tracemalloc.reset_peak()
+    _stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        _stack.pop()
+        _finish(record, seconds)
+
+
+def _finish(record, seconds):
+    """logs a finished stage, and carries its peak memory up to the stage it ran inside"""
+
+    record["seconds"] = round(seconds, 6)
+    if resource is not None:
+        scale = 2 ** 20 if sys.platform == "darwin" else 2 ** 10
+        record["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+    if record.get("rows") is not None:
+        record["rows"] = int(record["rows"])
+        record["rows_per_second"] = round(record["rows"] / seconds, 1) if seconds > 0 else None
+    if _settings["memory"]:
+        peak = max(tracemalloc.get_traced_memory()[1], record.pop("_child_peak", 0))
+        record["peak_mb"] = round((peak - record.pop("_start_mb")) / 2 ** 20, 3)
+        if _stack:
+            _stack[-1]["_child_peak"] = max(_stack[-1].get("_child_peak", 0), peak)
+    message = "%s took %.3fs" % (record["stage"], seconds)
+    if record.get("rows") is not None:
+        message += " for %d rows" % record["rows"]
+    if "peak_mb" in record:
+        message += ", peak %.1fMB" % record["peak_mb"]
+    logger.info(message, extra={"metrics": record})
+    if _settings["sink"] is not None:
+        with open(_settings["sink"], "a") as sink:
+            sink.write(json.dumps(record) + "\n")
+
+
+if os.environ.get("SPATIAL_HELPER_METRICS") or os.environ.get("SPATIAL_HELPER_PROFILE"):
+    enable(metrics_path=os.environ.get("SPATIAL_HELPER_METRICS"), memory=bool(os.environ.get("SPATIAL_HELPER_MEMORY")),
+           profile_path=os.environ.get("SPATIAL_HELPER_PROFILE"))
+    atexit.register(disable)
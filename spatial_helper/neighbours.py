@@ -0,0 +1,111 @@
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from h3.api import basic_int as h3_int
+from scipy import sparse
+from spatial_helper.create import HexGrid
+
+MAX_MEMORY_WEIGHTS = 8
+
+_weights = OrderedDict()
+
+
+def _grid_cells(grid, grid_ref="h3_ref"):
+    """returns the uint64 cells of a HexGrid or of a frame's h3 ref column, in row order"""
+
+    if isinstance(grid, HexGrid):
+        return grid.cells
+    return np.array([int(ref, 16) for ref in grid[grid_ref]], dtype="uint64")
+
+
+def _remember(key, weights, cells):
+    weights.cells = cells
+    _weights[key] = weights
+    _weights.move_to_end(key)
+    while len(_weights) > MAX_MEMORY_WEIGHTS:
+        _weights.popitem(last=False)
+    return weights
+
+
+def grid_weights(grid, k=1, include_self=True, kernel=None, grid_ref="h3_ref", cache_dir=None):
+    """builds a sparse n x n weight matrix over a grid's rows, linking every cell to the cells within k rings of it.
+    Weights are 1 unless a kernel is given, which maps a ring distance (0 to k) to a weight. The matrix carries the
+    grid's cells, in row order, as its cells attribute. The most recent matrices are kept in memory and, given a
+    cache directory, all of them on disk """
+
+    cells = _grid_cells(grid, grid_ref)
+    kernel_weights = [1.0 if kernel is None else float(kernel(distance)) for distance in range(k + 1)]
+    key = hashlib.sha1(cells.tobytes() + repr((k, include_self, kernel_weights)).encode("utf-8")).hexdigest()
+    if key in _weights:
+        _weights.move_to_end(key)
+        return _weights[key]
+    path = None if cache_dir is None else os.path.join(cache_dir, "weights_" + key + ".npz")
+    if path is not None and os.path.exists(path):
+        return _remember(key, sparse.load_npz(path).tocsr(), cells)
+    rows, neighbours, values = [], [], []
+    for row, cell in enumerate(cells.tolist()):
+        for distance, ring in enumerate(h3_int.k_ring_distances(cell, k)):
+            if distance == 0 and not include_self:
+                continue
+            rows.extend([row] * len(ring))
+            neighbours.extend(ring)
+            values.extend([kernel_weights[distance]] * len(ring))
+    columns = pd.Index(cells).get_indexer(np.array(neighbours, dtype="uint64"))
+    rows = np.array(rows, dtype="int64")
+    values = np.array(values, dtype="float64")
+    keep = columns >= 0
+    weights = sparse.csr_matrix((values[keep], (rows[keep], columns[keep])), shape=(len(cells), len(cells)))
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        sparse.save_npz(path, weights)
+    return _remember(key, weights, cells)
+
+
+def _aligned_values(frame, columns, weights, grid_ref="h3_ref", grid=None):
+    """returns the score columns in the row order of the weights, and each frame row's position in that order. The
+    order comes from the grid if one is given, otherwise from the cells grid_weights attached to the matrix """
+
+    cells = _grid_cells(grid, grid_ref) if grid is not None else getattr(weights, "cells", None)
+    values = frame[columns].to_numpy(dtype="float64")
+    if cells is None:
+        if len(frame) != weights.shape[0]:
+            raise ValueError("frame has {} rows but the weights cover {} cells".format(len(frame), weights.shape[0]))
+        return values, np.arange(len(frame))
+    positions = pd.Index(cells).get_indexer(_grid_cells(frame, grid_ref))
+    if len(cells) != weights.shape[0] or len(frame) != len(cells) or (positions < 0).any() or len(
+            np.unique(positions)) != len(positions):
+        raise ValueError("frame " + grid_ref + " values do not match the cells the weights were built from")
+    ordered = np.empty_like(values)
+    ordered[positions] = values
+    return ordered, positions
+
+
+def smooth(frame, columns, weights, grid_ref="h3_ref", grid=None):
+    """returns the weighted neighbourhood mean of every score column. Frame rows are matched to the weights by
+    grid_ref, in any order, and must cover the same cells """
+
+    values, positions = _aligned_values(frame, columns, weights, grid_ref, grid)
+    totals = np.asarray(weights.sum(axis=1)).ravel()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        smoothed = ((weights @ values) / totals[:, None])[positions]
+    result = pd.DataFrame(smoothed, columns=[column + "_smooth" for column in columns], index=frame.index)
+    return pd.concat([frame[[grid_ref]], result], axis=1)
+
+
+def getis_ord_gi_star(frame, columns, weights, grid_ref="h3_ref", grid=None):
+    """returns the Getis-Ord Gi* z-score of every score column, for weights built with include_self. Frame rows are
+    matched to the weights by grid_ref, in any order, and must cover the same cells """
+
+    values, positions = _aligned_values(frame, columns, weights, grid_ref, grid)
+    n = values.shape[0]
+    mean = values.mean(axis=0)
+    spread = np.sqrt((values ** 2).mean(axis=0) - mean ** 2)
+    weight_sum = np.asarray(weights.sum(axis=1)).ravel()[:, None]
+    weight_squares = np.asarray(weights.multiply(weights).sum(axis=1)).ravel()[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        denominator = spread * np.sqrt((n * weight_squares - weight_sum ** 2) / (n - 1))
+        z_scores = (((weights @ values) - mean * weight_sum) / denominator)[positions]
+    result = pd.DataFrame(z_scores, columns=[column + "_gi" for column in columns], index=frame.index)
+    return pd.concat([frame[[grid_ref]], result], axis=1)
@@ -0,0 +1,72 @@
+import pandas as pd
+from spatial_helper.ingest import (HOUR_COLUMNS, _drop_duplicate_points, _lat_lon_to_h3, _points_lat_lon,
+                                   hour_histogram, hour_stats)
+
+
+def _level_column(resolution):
+    return "res_" + str(resolution)
+
+
+def _levels(pyramid):
+    return [column for column in pyramid.columns if column.startswith("res_")]
+
+
+def build_pyramid(points, finest, coarsest=7, time_col="IncidentTime", start=0):
+    """takes a frame of points and bins it once into a pyramid covering every resolution from finest down to
+    coarsest. Use time_col="SUPV_CR_Recorded_Date" and start=8 for CRIS.
+
+    H3 children do not nest exactly inside their parent's polygon, so a point's h3_to_parent can differ from the
+    cell it falls in at the coarser resolution. Each leaf of the pyramid therefore keeps the point's own cell at every
+    level, and any level is a lookup and sum over the leaves, matching cad_to_grid on a grid of that resolution.
+    Points are reprojected once and indexed at each resolution from the same coordinates, and exact duplicate rows
+    are dropped as cad_to_grid does """
+
+    points = _drop_duplicate_points(points)
+    lat, lon = _points_lat_lon(points)
+    resolutions = list(range(finest, coarsest - 1, -1))
+    keys = pd.DataFrame({_level_column(resolution): _lat_lon_to_h3(lat, lon, resolution)
+                         for resolution in resolutions}, index=points.index)
+    leaves = pd.MultiIndex.from_frame(keys)
+    histogram = hour_histogram(points.assign(leaf=leaves.to_flat_index()), "leaf", time_col, start)
+    histogram.index = pd.MultiIndex.from_tuples(histogram.index, names=keys.columns)
+    return histogram.reset_index().astype({column: "uint64" for column in keys.columns})
+
+
+def merge_pyramids(total, pyramid):
+    """adds one pyramid onto another, such as when points arrive one file at a time"""
+
+    if total is None:
+        return pyramid
+    levels = _levels(total)
+    return pd.concat([total, pyramid], ignore_index=True).groupby(levels, as_index=False)[HOUR_COLUMNS].sum()
+
+
+def pyramid_histogram(pyramid, resolution):
+    """returns the per-hex hour histogram at one level of a pyramid, indexed by h3 cell id"""
+
+    return pyramid.groupby(_level_column(resolution))[HOUR_COLUMNS].sum()
+
+
+def pyramid_level(pyramid, resolution, grid=None, grid_ref="h3_ref"):
+    """returns the count, mean_hr and median_hr per hex at one level of a pyramid, keyed by h3 ref. Given a grid at
+    the same resolution the statistics are merged onto it, with 0 for empty hexes, as cad_to_grid does """
+
+    stats = hour_stats(pyramid_histogram(pyramid, resolution))
+    stats.index = pd.Index([format(cell, "x") for cell in stats.index.tolist()], dtype=object, name=grid_ref)
+    if grid is None:
+        return stats.reset_index()
+    grid_stats = grid.merge(stats, how="left", left_on=grid_ref, right_index=True)
+    grid_stats[stats.columns.to_list()] = grid_stats[stats.columns.to_list()].fillna(0)
+    return grid_stats
+
+
+def save_pyramid(pyramid, path):
+    """writes a pyramid to a parquet file"""
+
+    pyramid.to_parquet(path, index=False)
+
+
+def load_pyramid(path):
+    """reads a pyramid written by save_pyramid"""
+
+    return pd.read_parquet(path)
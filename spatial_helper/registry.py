@@ -0,0 +1,82 @@
+import hashlib
+import os
+from collections import OrderedDict
+import geopandas
+from spatial_helper.cache import DEFAULT_CACHE_BYTES, evict
+from spatial_helper.create import h3_from_boundary, h3_from_coordinates
+
+GRID_VERSION = 2
+MAX_MEMORY_GRIDS = 8
+
+_grids = OrderedDict()
+
+
+def grid_key(kind, resolution, *parts):
+    """returns a hash identifying a grid build from its kind, resolution and any other inputs, including the grid
+    code version so that changes to how grids are built invalidate old entries """
+
+    key = hashlib.sha1()
+    for part in (GRID_VERSION, kind, resolution) + parts:
+        key.update(part if isinstance(part, bytes) else repr(part).encode("utf-8"))
+        key.update(b"|")
+    return key.hexdigest()
+
+
+def boundary_key(boundary, resolution, buffer=0):
+    """returns the grid key for a boundary, hashing its geometries and CRS"""
+
+    geometries = b"".join(geometry.wkb for geometry in boundary.geometry)
+    return grid_key("boundary", resolution, geometries, str(boundary.crs), buffer)
+
+
+def _remember(key, grid):
+    _grids[key] = grid
+    _grids.move_to_end(key)
+    while len(_grids) > MAX_MEMORY_GRIDS:
+        _grids.popitem(last=False)
+
+
+def _cached_grid(key, build, cache_dir=None, max_bytes=DEFAULT_CACHE_BYTES):
+    """returns a copy of a grid from memory, then from disk, and only builds it when neither has it"""
+
+    if key in _grids:
+        _grids.move_to_end(key)
+        return _grids[key].copy()
+    path = None if cache_dir is None else os.path.join(cache_dir, key + ".parquet")
+    if path is not None and os.path.exists(path):
+        os.utime(path)
+        grid = geopandas.read_parquet(path)
+    else:
+        grid = build()
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp = path + "." + str(os.getpid()) + ".tmp"
+            grid.to_parquet(temp, index=False)
+            os.replace(temp, path)
+            evict(cache_dir, max_bytes, keep=[path])
+    _remember(key, grid)
+    return grid.copy()
+
+
+def cached_h3_from_boundary(boundary, resolution, buffer=0, cache_dir=None, max_bytes=DEFAULT_CACHE_BYTES):
+    """as h3_from_boundary, but memoised in memory and, given a cache directory, on disk, keyed by the boundary
+    geometry, resolution and buffer """
+
+    key = boundary_key(boundary, resolution, buffer)
+    return _cached_grid(key, lambda: h3_from_boundary(boundary.copy(), resolution, buffer), cache_dir, max_bytes)
+
+
+def cached_h3_from_coordinates(resolution, size, x=0, y=0, crs_type="osgb", cache_dir=None,
+                               max_bytes=DEFAULT_CACHE_BYTES):
+    """as h3_from_coordinates, but memoised in memory and, given a cache directory, on disk"""
+
+    key = grid_key("coordinates", resolution, size, x, y, crs_type)
+    return _cached_grid(key, lambda: h3_from_coordinates(resolution, size, x, y, crs_type), cache_dir, max_bytes)
+
+
+def clear_grid_cache(cache_dir=None):
+    """empties the in-memory grid registry, and the on-disk one if a cache directory is given"""
+
+    _grids.clear()
+    if cache_dir is not None and os.path.isdir(cache_dir):
+        evict(cache_dir, 0)
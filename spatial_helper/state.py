@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import time
+import pandas as pd
+from spatial_helper.cache import read_tab
+from spatial_helper.instrument import logger
+from spatial_helper.ingest import (CAD_COLUMNS, CRIS_COLUMNS, HOUR_COLUMNS, _as_grid, _exclude_shout,
+                                   _grid_with_stats, _points_in_grid, hour_histogram, hour_stats)
+
+STATE_COLUMNS = HOUR_COLUMNS + ["cchi"]
+
+
+def _add(total, contribution, sign=1):
+    """adds (or with sign -1, retracts) one file's per-hex statistics on a running total, dropping emptied hexes"""
+
+    if total is None:
+        total = pd.DataFrame(columns=STATE_COLUMNS, dtype="float64")
+    total = total.add(sign * contribution[STATE_COLUMNS], fill_value=0)
+    total[HOUR_COLUMNS] = total[HOUR_COLUMNS].round().astype("int64")
+    return total[total[HOUR_COLUMNS].sum(axis=1) > 0]
+
+
+class HexStateStore:
+    """a persistent store of per-hex sufficient statistics (hour histograms and CCHI sums) for one grid, with the
+    contribution of every ingested file kept so files can be folded in or retracted one at a time. Statistics are
+    grouped by a label, "cad" for CAD files and the major class for CRIS files """
+
+    def __init__(self, path, grid, grid_ref="h3_ref", method="h3", cache_dir=None):
+        self.path = path
+        self.grid = _as_grid(grid, method)
+        self.grid_ref = grid_ref
+        self.method = method
+        self.cache_dir = cache_dir
+        self._deferred = False
+        self._retracted = []
+        os.makedirs(os.path.join(path, "contributions"), exist_ok=True)
+        self.manifest = {}
+        if os.path.exists(self._manifest_path()):
+            with open(self._manifest_path()) as manifest:
+                self.manifest = json.load(manifest)
+        self.totals = {}
+        if os.path.exists(self._totals_path()):
+            saved = pd.read_parquet(self._totals_path())
+            self.totals = {label: totals.drop(columns="label").set_index(grid_ref)
+                           for label, totals in saved.groupby("label")}
+
+    def _manifest_path(self):
+        return os.path.join(self.path, "manifest.json")
+
+    def _totals_path(self):
+        return os.path.join(self.path, "totals.parquet")
+
+    def _contribution_path(self, key):
+        return os.path.join(self.path, "contributions", key + ".parquet")
+
+    @staticmethod
+    def _key(path):
+        return hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+
+    def _save(self):
+        totals = [total.rename_axis(self.grid_ref).reset_index().assign(label=label)
+                  for label, total in self.totals.items()]
+        if totals:
+            pd.concat(totals, ignore_index=True).to_parquet(self._totals_path() + ".tmp", index=False)
+            os.replace(self._totals_path() + ".tmp", self._totals_path())
+        elif os.path.exists(self._totals_path()):
+            os.remove(self._totals_path())
+        with open(self._manifest_path() + ".tmp", "w") as manifest:
+            json.dump(self.manifest, manifest, indent=1)
+        os.replace(self._manifest_path() + ".tmp", self._manifest_path())
+        kept = {entry.get("contribution", key) for key, entry in self.manifest.items()}
+        for stored in self._retracted:
+            if stored not in kept and os.path.exists(self._contribution_path(stored)):
+                os.remove(self._contribution_path(stored))
+        self._retracted = []
+
+    def _commit(self):
+        """saves the store, unless a directory sync is running, which saves once when it finishes"""
+
+        if not self._deferred:
+            self._save()
+
+    def _fold(self, path, kind, label, contribution, rows):
+        """records one file's contribution, replacing any earlier version of the same file"""
+
+        if self._key(path) in self.manifest:
+            self.remove_file(path)
+        key = self._key(path)
+        stat = os.stat(path)
+        stored = key + "_" + str(stat.st_mtime_ns)
+        contribution.rename_axis(self.grid_ref).reset_index().to_parquet(self._contribution_path(stored),
+                                                                         index=False)
+        self.totals[label] = _add(self.totals.get(label), contribution)
+        self.manifest[key] = {"path": os.path.abspath(path), "kind": kind, "label": label, "rows": rows,
+                              "size": stat.st_size, "mtime": stat.st_mtime, "added": time.time(),
+                              "contribution": stored}
+        self._commit()
+
+    def _assign(self, points):
+        if self.method == "sjoin" and points.crs != self.grid.crs:
+            points = points.set_crs(self.grid.crs, allow_override=True)
+        return _points_in_grid(points, self.grid, self.grid_ref, self.method)
+
+    def add_cad_file(self, path, exclude_shout=True):
+        """folds one CAD .tab file into the store"""
+
+        cads = read_tab(path, CAD_COLUMNS, self.cache_dir)
+        if exclude_shout:
+            cads = _exclude_shout(cads)
+        contribution = hour_histogram(self._assign(cads), self.grid_ref).assign(cchi=0.0)
+        self._fold(path, "cad", "cad", contribution, len(cads))
+
+    def add_cris_file(self, path, major_class=None, cchi_lookup=None, minor_class=None, class_col="minor_class"):
+        """folds one CRIS .tab file into the store under its major class, taken from the file name by default. Given
+        a CCHI lookup, the harm score per hex is kept as well, weighting each crime by the minor class in its
+        class_col column. Files without that column use minor_class, either one class for the whole file or a dict
+        of file name to class """
+
+        if major_class is None:
+            major_class = os.path.basename(path).split("_")[0].replace(" ", "")
+        crimes = read_tab(path, CRIS_COLUMNS + [class_col], self.cache_dir)
+        assigned = self._assign(crimes)
+        contribution = hour_histogram(assigned, self.grid_ref, "SUPV_CR_Recorded_Date", 8)
+        harm = pd.Series(0.0, index=assigned.index)
+        if cchi_lookup is not None:
+            weights = cchi_lookup.drop_duplicates(subset="cris_minor").set_index("cris_minor")["CrimeHarm"].astype(
+                "float")
+            if class_col in assigned.columns:
+                classes = assigned[class_col]
+            else:
+                if isinstance(minor_class, dict):
+                    minor_class = minor_class.get(os.path.basename(path))
+                classes = pd.Series(minor_class, index=assigned.index)
+            harm = classes.map(weights)
+            missing = classes[harm.isna()].unique()
+            if len(missing):
+                logger.warning("No CCHI weight for %s in %s", ", ".join(str(name) for name in missing), path)
+            harm = harm.fillna(0.0)
+        cchi = harm.groupby(assigned[self.grid_ref], observed=True).sum()
+        cchi.index = cchi.index.astype(object)
+        contribution["cchi"] = cchi.reindex(contribution.index).fillna(0.0)
+        self._fold(path, "cris", major_class, contribution, len(crimes))
+
+    def remove_file(self, path):
+        """retracts a previously folded file from the store"""
+
+        key = self._key(path)
+        entry = self.manifest.pop(key)
+        stored = entry.get("contribution", key)
+        contribution = pd.read_parquet(self._contribution_path(stored)).set_index(self.grid_ref)
+        self.totals[entry["label"]] = _add(self.totals.get(entry["label"]), contribution, -1)
+        if self.totals[entry["label"]].empty:
+            del self.totals[entry["label"]]
+        self._retracted.append(stored)
+        self._commit()
+
+    def _changed(self, path):
+        entry = self.manifest.get(self._key(path))
+        if entry is None:
+            return True
+        stat = os.stat(path)
+        return entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime
+
+    def sync_directory(self, directory, kind="cad", max_age_days=None, **kwargs):
+        """brings the store in line with a directory of .tab files: new or changed files are folded in, and files
+        that have gone or are older than max_age_days (by modification time) are retracted. Extra keyword arguments
+        go to add_cad_file or add_cris_file. The totals and manifest are written once, when the sync finishes """
+
+        self._deferred = True
+        try:
+            self._sync(directory, kind, max_age_days, **kwargs)
+        finally:
+            self._deferred = False
+            self._save()
+
+    def _sync(self, directory, kind, max_age_days, **kwargs):
+        now = time.time()
+        wanted = []
+        for filename in sorted(os.listdir(directory)):
+            path = os.path.abspath(os.path.join(directory, filename))
+            if filename.endswith(".tab") and (
+                    max_age_days is None or now - os.path.getmtime(path) <= max_age_days * 86400):
+                wanted.append(path)
+        directory = os.path.abspath(directory)
+        for entry in list(self.manifest.values()):
+            if entry["kind"] == kind and os.path.dirname(entry["path"]) == directory and entry["path"] not in wanted:
+                logger.info("Retracting file %s", entry["path"])
+                self.remove_file(entry["path"])
+        add_file = self.add_cad_file if kind == "cad" else self.add_cris_file
+        for path in wanted:
+            if self._changed(path):
+                logger.info("Processing file %s", path)
+                add_file(path, **kwargs)
+
+    def files(self):
+        """returns the provenance of every file in the store"""
+
+        return pd.DataFrame(list(self.manifest.values()))
+
+    def table(self, label="cad", grid=None):
+        """returns the grid with the current count, mean_hr, median_hr and cchi per hex for one label"""
+
+        totals = self.totals.get(label, pd.DataFrame(columns=STATE_COLUMNS, dtype="int64"))
+        stats = hour_stats(totals).assign(cchi=totals["cchi"].astype("float64"))
+        return _grid_with_stats(self.grid if grid is None else grid, self.grid_ref, stats)
@@ -0,0 +1,23 @@
+import geopandas
+import numpy as np
+import pytest
+import shapely
+from spatial_helper.create import build_h3_grid, h3_from_boundary
+
+
+@pytest.fixture
+def boundary():
+    shape = shapely.Point(530000, 180000).buffer(4000).union(shapely.box(531000, 176000, 536000, 179000))
+    return geopandas.GeoDataFrame(geometry=[shape], crs="EPSG:27700")
+
+
+@pytest.mark.parametrize("resolution,compact_resolution", [(9, 7), (10, 7), (10, 8)])
+def test_compact_interior_fill_matches_polyfill(boundary, resolution, compact_resolution):
+    expected = h3_from_boundary(boundary, resolution, lazy=True).cells
+    compacted = build_h3_grid(boundary, resolution, workers=1, compact_resolution=compact_resolution, lazy=True)
+    assert np.array_equal(compacted.cells, expected)
+
+
+def test_tiled_fill_matches_polyfill(boundary):
+    expected = h3_from_boundary(boundary, 9, lazy=True).cells
+    assert np.array_equal(build_h3_grid(boundary, 9, tiles=3, workers=1, lazy=True).cells, expected)
@@ -0,0 +1,36 @@
+import geopandas
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from spatial_helper import display
+from spatial_helper.create import h3_from_coordinates
+
+
+def _bcu_inputs(lazy):
+    grid = h3_from_coordinates(9, 2000, x=180000, y=530000, lazy=lazy)
+    refs = grid.to_frame()["h3_ref"] if lazy else grid["h3_ref"]
+    rng = np.random.default_rng(0)
+    geodata = pd.DataFrame({"h3_ref": refs.to_numpy(),
+                            "BCU_Name": rng.choice(["North", "South", "West"], len(refs)),
+                            "t_centre_name": rng.choice(["Croydon", "Ealing", "Romford"], len(refs)),
+                            "Final_score": rng.gamma(2, 10, len(refs)).round(2),
+                            "Previous entries": rng.integers(0, 3, len(refs))})
+    geodata.loc[rng.choice(len(refs), 20, replace=False), "t_centre_name"] = None
+    geodata = geodata.sort_values(by="Final_score", ascending=False, ignore_index=True)
+    edges = np.linspace(-3000, 3000, 5)
+    boxes = [shapely.box(530000 + x0, 180000 + y0, 530000 + x1, 180000 + y1)
+             for x0, x1 in zip(edges[:-1], edges[1:]) for y0, y1 in zip(edges[:-1], edges[1:])]
+    wards = geopandas.GeoDataFrame({"ward": ["W" + str(number) for number in range(len(boxes))]}, geometry=boxes,
+                                   crs="EPSG:27700").to_crs(grid.crs)
+    return wards, grid, geodata
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_batch_bcu_maps_match_single(tmp_path, lazy):
+    wards, grid, geodata = _bcu_inputs(lazy)
+    display.make_bcu_maps(wards, grid, geodata, str(tmp_path / "batch"), workers=1)
+    for name in ["North", "South", "West"]:
+        display.make_bcu_map(wards, grid, geodata, name, output_dir=str(tmp_path / "single"))
+        single = (tmp_path / "single" / (name + "_map.csv")).read_text()
+        assert (tmp_path / "batch" / (name + "_map.csv")).read_text() == single
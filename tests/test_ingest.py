@@ -0,0 +1,92 @@
+import geopandas
+import numpy as np
+import pandas as pd
+import pytest
+from spatial_helper import ingest
+from spatial_helper.create import h3_from_coordinates
+
+
+def _cads(n, seed):
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame({"IncidentNumber": np.arange(n).astype(str),
+                          "IncidentTime": ["{:02d}:30".format(hour) for hour in rng.integers(0, 24, n)],
+                          "OpeningCode_Description": rng.choice(["ASB Nuisance", "Concern For Safety"], n),
+                          "X": rng.uniform(528500, 531500, n).round(), "Y": rng.uniform(178500, 181500, n).round()})
+    return geopandas.GeoDataFrame(frame, geometry=geopandas.points_from_xy(frame.X, frame.Y), crs="EPSG:27700")
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_hour_stats_matches_raw_mean_and_median(seed):
+    rng = np.random.default_rng(seed)
+    points = pd.DataFrame({"h3_ref": rng.choice(["a", "b", "c", "d", "e"], 500),
+                           "IncidentTime": ["{:02d}:00".format(hour) for hour in rng.integers(0, 24, 500)]})
+    points.loc[points["h3_ref"] == "e", "IncidentTime"] = "07:00"
+    halves = [ingest.hour_histogram(part, "h3_ref") for part in np.array_split(points, 3)]
+    histogram = None
+    for half in halves:
+        histogram = ingest.merge_histograms(histogram, half)
+    stats = ingest.hour_stats(histogram)
+    hours = points["IncidentTime"].str.slice(0, 2).astype("int")
+    expected = hours.groupby(points["h3_ref"]).agg(["count", "mean", "median"])
+    assert (stats.loc[expected.index, "count"] == expected["count"]).all()
+    assert np.allclose(stats.loc[expected.index, "mean_hr"], expected["mean"])
+    assert np.allclose(stats.loc[expected.index, "median_hr"], expected["median"])
+
+
+@pytest.mark.parametrize("time", ["day", "night"])
+def test_cad_time_batch_and_streaming_agree(tmp_path, time):
+    grid = h3_from_coordinates(8, 2000, x=180000, y=530000, lazy=True)
+    for number in range(2):
+        _cads(500, number).to_file(str(tmp_path / ("b" + str(number) + ".tab")), driver="MapInfo File")
+    batch = ingest.agg_cad_directory_time(str(tmp_path), grid, "h3_ref", method="h3", time=time)
+    streamed = ingest.agg_cad_directory_time(str(tmp_path), grid, "h3_ref", method="h3", time=time, streaming=True)
+    assert "h3_ref" in batch.columns and "CAD_Ref" not in batch.columns
+    merged = batch.merge(streamed, on="h3_ref")
+    assert len(merged) == len(grid)
+    assert np.array_equal(merged[time + "_count_x"], merged[time + "_count_y"])
+
+
+@pytest.mark.parametrize("chunksize", [None, 150])
+def test_streaming_drops_records_repeated_across_files(tmp_path, chunksize):
+    grid = h3_from_coordinates(8, 2000, x=180000, y=530000, lazy=True)
+    cads = _cads(500, 4)
+    for name in ["a.tab", "b.tab"]:
+        cads.to_file(str(tmp_path / name), driver="MapInfo File")
+    _cads(300, 5).to_file(str(tmp_path / "c.tab"), driver="MapInfo File")
+    batch = ingest.agg_cad_directory(str(tmp_path), grid, "h3_ref", method="h3")
+    streamed = ingest.agg_cad_directory(str(tmp_path), grid, "h3_ref", method="h3", streaming=True,
+                                        chunksize=chunksize)
+    merged = batch.merge(streamed, on="h3_ref")
+    for column in ["count", "mean_hr", "median_hr"]:
+        assert np.allclose(merged[column + "_x"], merged[column + "_y"])
+    assert batch["count"].sum() < 800
+
+
+def test_h3_binning_matches_sjoin():
+    grid = h3_from_coordinates(8, 2000, x=180000, y=530000)
+    cads = _cads(1000, 3)
+    cads = pd.concat([cads, cads.iloc[:200]], ignore_index=True)
+    joined = ingest.cad_to_grid(grid.copy(), "h3_ref", cads)
+    binned = ingest.cad_to_grid(grid.copy(), "h3_ref", cads, method="h3")
+    merged = joined.merge(binned, on="h3_ref")
+    for column in ["count", "mean_hr", "median_hr"]:
+        assert np.allclose(merged[column + "_x"], merged[column + "_y"])
+    assert binned["count"].sum() == len(ingest.h3_grid_refs(cads.iloc[:1000], grid, "h3_ref").dropna())
+
+
+@pytest.mark.parametrize("method", ["sjoin", "h3"])
+def test_cad_to_grid_cats_matches_cad_to_grid_per_code(method):
+    grid = h3_from_coordinates(8, 2000, x=180000, y=530000)
+    cads = _cads(1200, 6)
+    codes = list(ingest.CAD_CATEGORIES) + ["Concern For Safety"]
+    cads["OpeningCode_Description"] = np.random.default_rng(6).choice(codes, len(cads))
+    expected = {code: ingest.cad_to_grid(grid.copy(), "h3_ref", cads[cads["OpeningCode_Description"] == code],
+                                         method).set_index("h3_ref") for code in codes}
+    forms = [(ingest.CAD_CATEGORIES, ingest.CAD_CATEGORIES),
+             (None, {code: ingest._category_suffix(code) for code in codes}),
+             (["Concern For Safety"], {"Concern For Safety": "_concern_for_safety"})]
+    for given, suffixes in forms:
+        result = ingest.cad_to_grid_cats(grid.copy(), "h3_ref", cads, method, codes=given).set_index("h3_ref")
+        for code, suffix in suffixes.items():
+            for stat in ["count", "mean_hr", "median_hr"]:
+                assert np.allclose(result.loc[expected[code].index, stat + suffix], expected[code][stat])
@@ -0,0 +1,50 @@
+import h3
+import numpy as np
+import pytest
+from spatial_helper import neighbours
+from spatial_helper.create import h3_from_coordinates
+
+
+def _scored_grid(seed):
+    grid = h3_from_coordinates(8, 1500, x=180000, y=530000, lazy=True)
+    frame = grid.to_frame()
+    frame["score"] = np.random.default_rng(seed).poisson(3, len(frame)).astype("float64")
+    return grid, frame
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_shuffled_frame_scores_match_sorted(seed):
+    grid, frame = _scored_grid(seed)
+    weights = neighbours.grid_weights(grid, 1)
+    shuffled = frame.sample(frac=1, random_state=seed)
+    for function, column in [(neighbours.smooth, "score_smooth"), (neighbours.getis_ord_gi_star, "score_gi")]:
+        expected = function(frame, ["score"], weights).set_index("h3_ref")[column]
+        result = function(shuffled, ["score"], weights).set_index("h3_ref")[column]
+        assert np.allclose(result.loc[expected.index], expected)
+        given_grid = function(shuffled, ["score"], weights, grid=grid).set_index("h3_ref")[column]
+        assert np.allclose(given_grid.loc[expected.index], expected)
+
+
+def test_gi_star_and_smooth_match_hand_computed_cell():
+    grid, frame = _scored_grid(2)
+    weights = neighbours.grid_weights(grid, 1)
+    values = frame.set_index("h3_ref")["score"]
+    ref = next(ref for ref in values.index if h3.k_ring(ref, 1) <= set(values.index))
+    ring = values.loc[sorted(h3.k_ring(ref, 1))]
+    n, mean = len(values), values.mean()
+    spread = np.sqrt((values ** 2).mean() - mean ** 2)
+    weight_sum = weight_squares = len(ring)
+    expected = (ring.sum() - mean * weight_sum) / (spread * np.sqrt((n * weight_squares - weight_sum ** 2) / (n - 1)))
+    gi = neighbours.getis_ord_gi_star(frame, ["score"], weights).set_index("h3_ref")["score_gi"]
+    smoothed = neighbours.smooth(frame, ["score"], weights).set_index("h3_ref")["score_smooth"]
+    assert np.isclose(gi[ref], expected)
+    assert np.isclose(smoothed[ref], ring.mean())
+
+
+def test_frame_with_other_cells_is_rejected():
+    grid, frame = _scored_grid(3)
+    weights = neighbours.grid_weights(grid, 1)
+    with pytest.raises(ValueError):
+        neighbours.smooth(frame.iloc[1:], ["score"], weights)
+    with pytest.raises(ValueError):
+        neighbours.getis_ord_gi_star(frame.iloc[1:], ["score"], weights)
@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+import pytest
+from spatial_helper import ingest, pyramid
+from spatial_helper.create import h3_from_coordinates
+from tests.test_ingest import _cads
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_pyramid_levels_match_cad_to_grid(seed):
+    cads = _cads(800, seed)
+    cads = pd.concat([cads, cads.iloc[:100]], ignore_index=True)
+    pyr = pyramid.build_pyramid(cads, 9, 7)
+    assert pyr[ingest.HOUR_COLUMNS].to_numpy().sum() == len(cads) - 100
+    for resolution in [9, 8, 7]:
+        grid = h3_from_coordinates(resolution, 2000, x=180000, y=530000, lazy=True)
+        expected = ingest.cad_to_grid(grid, "h3_ref", cads, method="h3")
+        levelled = pyramid.pyramid_level(pyr, resolution, grid=grid.to_frame())
+        merged = expected.merge(levelled, on="h3_ref")
+        assert len(merged) == len(grid)
+        for column in ["count", "mean_hr", "median_hr"]:
+            assert np.allclose(merged[column + "_x"], merged[column + "_y"])
@@ -0,0 +1,47 @@
+import os
+import geopandas
+import numpy as np
+import pandas as pd
+from spatial_helper import ingest
+from spatial_helper.create import h3_from_coordinates
+from spatial_helper.state import HexStateStore
+
+
+def _write_cris(directory, name, n, seed):
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame({"CRNumber": ["CR" + str(seed) + "-" + str(number) for number in range(n)],
+                          "SUPV_CR_Recorded_Date": ["20210101{:02d}00".format(hour) for hour in rng.integers(0, 24, n)],
+                          "minor_class": rng.choice(["minor_0", "minor_1", "minor_2"], n),
+                          "X": rng.uniform(528500, 531500, n).round(), "Y": rng.uniform(178500, 181500, n).round()})
+    crimes = geopandas.GeoDataFrame(frame, geometry=geopandas.points_from_xy(frame.X, frame.Y), crs="EPSG:27700")
+    crimes.to_file(os.path.join(directory, name), driver="MapInfo File")
+    return crimes
+
+
+def _expected(crimes, grid, lookup):
+    crimes = pd.concat(crimes, ignore_index=True)
+    counts = ingest.crime_cad_grid(crimes, grid, "h3_ref", "Burglary", "h3")
+    harm = ingest.calc_cchi_batch(grid, crimes, lookup, method="h3")
+    return counts.merge(harm, on="h3_ref")
+
+
+def test_sync_and_retraction_match_a_fresh_aggregate(tmp_path):
+    grid = h3_from_coordinates(8, 2000, x=180000, y=530000, lazy=True)
+    lookup = pd.DataFrame({"cris_minor": ["minor_0", "minor_1", "minor_2"], "CrimeHarm": [1.0, 2.5, 10.0]})
+    data = tmp_path / "cris"
+    data.mkdir()
+    crimes = [_write_cris(str(data), "Burglary_" + str(number) + ".tab", 400, number) for number in range(3)]
+    store = HexStateStore(str(tmp_path / "store"), grid)
+    store.sync_directory(str(data), kind="cris", cchi_lookup=lookup)
+    for name in os.listdir(data):
+        if name.startswith("Burglary_1."):
+            os.remove(data / name)
+    store = HexStateStore(str(tmp_path / "store"), grid)
+    store.sync_directory(str(data), kind="cris", cchi_lookup=lookup)
+
+    table = store.table("Burglary").merge(_expected([crimes[0], crimes[2]], grid, lookup), on="h3_ref")
+    assert np.array_equal(table["count"], table["Burglary_count"])
+    assert np.allclose(table["mean_hr"].fillna(0), table["Burglary_mean_hr"])
+    assert np.allclose(table["median_hr"].fillna(0), table["Burglary_median_hr"])
+    assert np.allclose(table["cchi"], table["CCHI_score"])
+    assert len(os.listdir(tmp_path / "store" / "contributions")) == 2